@@ -0,0 +1,86 @@
+import pandas as pd
+import logging
+from pathlib import Path
+import json
+import datetime
+
+# 只获取logger实例，不进行配置
+logger = logging.getLogger(__name__)
+
+# 增量抽取的缓存目录，与其它产出文件一起放在 df_data 下
+DEFAULT_CACHE_DIR = Path(__file__).parent / "df_data" / "cache"
+
+def _state_path(cache_dir: Path, name: str) -> Path:
+    return cache_dir / f"{name}.state.json"
+
+def _frame_path(cache_dir: Path, name: str) -> Path:
+    return cache_dir / f"{name}.pkl"
+
+def load_cache(name: str, version: int, cache_dir=None, params: dict = None):
+    """
+    读取增量缓存：上次处理到的水位线以及已解析的数据。
+
+    Args:
+        name (str): 缓存名称，不同的数据源/解析模式使用不同名称。
+        version (int): 缓存格式版本，解析结果的列结构变化时递增，版本不一致的缓存将被丢弃。
+        cache_dir (str | Path, optional): 缓存目录，默认为 df_data/cache。
+        params (dict, optional): 生成缓存时使用的抽取参数（例如排除的用户），与缓存中记录的不一致时缓存将被丢弃。
+
+    Returns:
+        tuple: (watermark, DataFrame)。缓存不存在或不可用时返回 (None, None)。
+    """
+    cache_dir = Path(cache_dir) if cache_dir else DEFAULT_CACHE_DIR
+    state_path = _state_path(cache_dir, name)
+    frame_path = _frame_path(cache_dir, name)
+    if not state_path.exists() or not frame_path.exists():
+        logger.info(f"未找到缓存 {name}，将进行全量抽取。")
+        return None, None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('version') != version:
+            logger.info(f"缓存 {name} 的版本 {state.get('version')} 与当前版本 {version} 不一致，将进行全量抽取。")
+            return None, None
+        if state.get('params') != params:
+            logger.info(f"缓存 {name} 的抽取参数 {state.get('params')} 与当前参数 {params} 不一致，将进行全量抽取。")
+            return None, None
+        df = pd.read_pickle(frame_path)
+        logger.info(f"读取缓存 {name} 成功，水位线: {state.get('watermark')}，共 {len(df)} 行。")
+        return state.get('watermark'), df
+    except Exception as e:
+        logger.warning(f"读取缓存 {name} 失败，将进行全量抽取: {e}")
+        return None, None
+
+def save_cache(name: str, version: int, watermark, df: pd.DataFrame, cache_dir=None, params: dict = None):
+    """
+    保存增量缓存。先写入临时文件再替换，避免任务中断时留下半个缓存。
+
+    Args:
+        name (str): 缓存名称。
+        version (int): 缓存格式版本。
+        watermark: 本次处理到的最大 updated_at。
+        df (pd.DataFrame): 已解析的数据。
+        cache_dir (str | Path, optional): 缓存目录，默认为 df_data/cache。
+        params (dict, optional): 生成缓存时使用的抽取参数，需可JSON序列化。
+    """
+    cache_dir = Path(cache_dir) if cache_dir else DEFAULT_CACHE_DIR
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    frame_path = _frame_path(cache_dir, name)
+    state_path = _state_path(cache_dir, name)
+
+    tmp_frame_path = frame_path.with_suffix('.pkl.tmp')
+    df.to_pickle(tmp_frame_path)
+    tmp_frame_path.replace(frame_path)
+
+    state = {
+        'version': version,
+        'watermark': watermark,
+        'params': params,
+        'rows': len(df),
+        'saved_at': datetime.datetime.now().isoformat(),
+    }
+    tmp_state_path = state_path.with_suffix('.json.tmp')
+    with open(tmp_state_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    tmp_state_path.replace(state_path)
+    logger.info(f"缓存 {name} 已保存，水位线: {watermark}，共 {len(df)} 行。")
@@ -1,134 +1,1055 @@
 from sqlalchemy import create_engine
 import pandas as pd
+import numpy as np
 import logging
 from pathlib import Path
 import json
-import datetime
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 
-from db_utils import get_db_engine, query_db
+from db_utils import get_db_engine, query_db, query_db_chunks, DEFAULT_CHUNKSIZE, DEFAULT_EXCLUDED_USERS, \
+    excluded_users_clause, reset_engines_after_fork
+from cache_utils import load_cache, save_cache
+import json_codec
+from frame_utils import ColumnBuilder, DEFAULT_TIMEZONE, categorize_columns, convert_epoch_columns, recode_categories
+from model_aliases import DEFAULT_MODEL_ALIAS_TABLE, apply_model_alias_table
 
 # 只获取logger实例，不进行配置
 logger = logging.getLogger(__name__)
 
-def _fetch_raw_chat_data(engine) -> pd.DataFrame:
+# 消息抽取方式：python 在Python中逐个解析会话JSON；sql 使用SQLite JSON1在数据库内展开消息
+EXTRACT_MODES = ('python', 'sql')
+
+# 消息范围：all 保留 history.messages 中的全部消息（包括重新生成和编辑产生的分支）；
+# active 只保留从 history.currentId 沿 parentId 回溯得到的当前分支
+BRANCH_MODES = ('all', 'active')
+
+# 问答配对方式：index 在解析时按 parentId 建立最新回答的索引，直接得到问答对；
+# pandas 先输出全部消息，再由 _create_chat_view 拆分、排序、去重并合并，作为对照的参考实现
+PAIRING_MODES = ('index', 'pandas')
+
+# 增量缓存的名称和格式版本，解析结果的列结构变化时需要递增版本；
+# 仅统计模式的解析结果没有消息正文，使用单独的缓存
+CHAT_CACHE_NAME = "chat_messages"
+CHAT_METRICS_CACHE_NAME = "chat_messages_metrics"
+CHAT_CACHE_VERSION = 12
+
+class _Extraction(NamedTuple):
+    """
+    一次抽取的结果。
     """
-    从数据库中获取原始聊天数据。
+    parsed_df: pd.DataFrame  # 解析出的消息
+    fetched_ids: list  # 重新解析的会话ID，增量合并时替换缓存中这些会话的消息
+    max_updated_at: int  # 本次读取到的最大 updated_at
+    fingerprints: dict  # 重新解析的会话的指纹 {会话ID: 指纹}
+    unchanged: dict  # 内容指纹未变、跳过解析的会话 {会话ID: updated_at}
+
+# 并行解析时每个worker平均分到的rowid区间数，区间切得更细可以平衡各区间会话大小不均的问题
+PARTITIONS_PER_WORKER = 4
+
+def _chat_filter(since=None, rowid_range=None, excluded_users=DEFAULT_EXCLUDED_USERS):
     """
-    query = """
+    构造读取chat表时共用的过滤条件。
+
+    Args:
+        since (int, optional): 增量水位线。
+        rowid_range (tuple, optional): 并行解析时的 (起始rowid, 结束rowid) 闭区间。
+        excluded_users (Iterable[str]): 不计入统计的用户名或用户ID，这些用户的会话不会被读出。
+
+    Returns:
+        tuple: (WHERE子句内容, SQL参数)
+    """
+    excluded, params = excluded_users_clause(excluded_users)
+    where = f"meta != '{{}}' AND {excluded}"
+    if since is not None:
+        # 使用 >= 而不是 >，同一秒内后写入的会话也不会漏掉；重复读取的会话会在合并时被替换
+        where += " AND updated_at >= :since"
+        params['since'] = since
+    if rowid_range is not None:
+        where += " AND rowid BETWEEN :rowid_start AND :rowid_end"
+        params['rowid_start'], params['rowid_end'] = rowid_range
+    return where, params
+
+def _fetch_raw_chat_data(engine, since=None, chunksize: int = DEFAULT_CHUNKSIZE, rowid_range=None,
+                         excluded_users=DEFAULT_EXCLUDED_USERS):
+    """
+    从数据库中分块获取原始聊天数据，按rowid排序，保证串行和并行解析的结果顺序一致。
+
+    Args:
+        engine: SQLAlchemy引擎。
+        since (int, optional): 增量水位线，只读取 updated_at 不早于该值的会话；为 None 时读取全部。
+        chunksize (int): 每块的会话数。
+        rowid_range (tuple, optional): 只读取该rowid闭区间内的会话。
+        excluded_users (Iterable[str]): 不读取这些用户（用户名或用户ID）的会话。
+
+    Yields:
+        pd.DataFrame: 原始chat记录块。
+    """
+    where, params = _chat_filter(since, rowid_range, excluded_users)
+    query = f"""
         SELECT b.name, a.*
         FROM (
-            SELECT * FROM chat WHERE meta != '{}'
+            SELECT rowid AS chat_rowid, * FROM chat WHERE {where}
         ) a
         LEFT JOIN (
             SELECT id, name FROM user
-        ) b ON a.user_id = b.id;
+        ) b ON a.user_id = b.id
+        ORDER BY a.chat_rowid;
     """
-    df = query_db(query, engine)
-    logger.info(f"成功读取chat表数据，共 {len(df)} 条记录")
-    return df
+    return query_db_chunks(query, engine, chunksize=chunksize, params=params)
 
-def _parse_chat_messages(chat_df: pd.DataFrame) -> pd.DataFrame:
+def _fetch_chat_messages_sql(engine, since=None, chunksize: int = DEFAULT_CHUNKSIZE, metrics_only: bool = False,
+                             rowid_range=None, excluded_users=DEFAULT_EXCLUDED_USERS, branch_mode: str = 'all'):
+    """
+    使用SQLite的JSON1函数在数据库内展开 history.messages，分块返回消息级数据。
+    会话JSON只在SQLite中解析，Python侧只接收需要的字段。
+
+    Args:
+        engine: SQLAlchemy引擎。
+        since (int, optional): 增量水位线，含义同 _fetch_raw_chat_data。
+        chunksize (int): 每块的消息数。
+        metrics_only (bool): 为 True 时不返回消息正文，只在SQL中计算其字符数和UTF-8字节数。
+        rowid_range (tuple, optional): 只读取该rowid闭区间内的会话。
+        excluded_users (Iterable[str]): 不读取这些用户（用户名或用户ID）的会话。
+        branch_mode (str): 为 'active' 时额外返回 current_id 列（history.currentId），
+            当前分支在所有消息读出后由 _filter_active_branch 筛选。
+
+    Yields:
+        pd.DataFrame: 消息级记录块，列与 _parse_chat_messages 的结果一一对应（时间戳尚未转换），
+            另有计数用的 picked_models 列。
+    """
+    where, params = _chat_filter(since, rowid_range, excluded_users)
+    if metrics_only:
+        # 非字符串的 content 与Python解析路径一样按0计
+        content_columns = """
+            CASE WHEN json_type(m.value, '$.content') = 'text'
+                THEN length(json_extract(m.value, '$.content')) ELSE 0 END AS content_length,
+            CASE WHEN json_type(m.value, '$.content') = 'text'
+                THEN length(CAST(json_extract(m.value, '$.content') AS BLOB)) ELSE 0 END AS content_bytes"""
+    else:
+        content_columns = """
+            json_extract(m.value, '$.content') AS content"""
+    # token用量按 usage、info 块和 CHAT_USAGE_KEYS 的顺序取第一个非空值，与 _usage_metrics 一致；
+    # 纳秒换算和数值转换在 _convert_sql_messages 中进行
+    for column, keys in CHAT_USAGE_KEYS.items():
+        candidates = ", ".join(f"json_extract(m.value, '$.{block}.{key}')" for block in USAGE_BLOCKS for key in keys)
+        content_columns += f""",
+            COALESCE({candidates}) AS {column}"""
+    # 回答状态的判断顺序与 _answer_status 一致
+    content_columns += """,
+            CASE
+                WHEN json_extract(m.value, '$.role') IS NOT 'assistant' THEN NULL
+                WHEN json_type(m.value, '$.error') NOT IN ('null', 'false') THEN 'error'
+                WHEN json_type(m.value, '$.done') = 'false' THEN 'aborted'
+                WHEN json_type(m.value, '$.content') IS NOT 'text'
+                    OR trim(json_extract(m.value, '$.content'), ' ' || char(9, 10, 13)) = '' THEN 'empty'
+                ELSE 'ok'
+            END AS answer_status"""
+    # 用户为问题选择的模型（JSON数组），取值规则与 _picked_models 一致，由 _count_answers 使用后去掉
+    content_columns += """,
+            CASE WHEN json_extract(m.value, '$.role') = 'user' THEN COALESCE(
+                CASE WHEN json_array_length(m.value, '$.models') > 0 THEN json_extract(m.value, '$.models') END,
+                CASE WHEN json_array_length(a.chat_models) > 0 THEN a.chat_models END
+            ) END AS picked_models"""
+    if branch_mode == 'active':
+        content_columns += """,
+            a.current_id"""
+    # 会话级字段在 MATERIALIZED CTE 中每个会话只提取一次。若直接在消息行上写 json_extract(a.chat, ...)，
+    # 每条消息都会重新解析整个会话JSON（SQLite 3.45 之前没有JSON解析缓存），耗时随会话长度成平方增长。
+    # json_valid 过滤掉无法解析的会话，与Python解析路径跳过 JSONDecodeError 的行为一致
+    # （NaN/Infinity 除外：Python路径退回标准库 json 可以解析，SQLite则认为不合法）。
+    # 同一会话内按 json_each 的 id 排序，消息保持 history.messages 中的顺序，配对时的并列规则见 _answer_rank
+    query = f"""
+        WITH a AS MATERIALIZED (
+            SELECT
+                rowid AS chat_rowid,
+                id,
+                user_id,
+                created_at,
+                updated_at,
+                chat,
+                json_extract(chat, '$.id') AS chat_id,
+                json_extract(chat, '$.title') AS chat_title,
+                json_extract(chat, '$.models[#-1]') AS last_chat_model,
+                json_extract(chat, '$.models') AS chat_models,
+                json_extract(chat, '$.history.currentId') AS current_id
+            FROM chat WHERE {where} AND json_valid(chat)
+        )
+        SELECT
+            a.id AS chat_db_id,
+            a.chat_id,
+            a.user_id AS chat_user_id,
+            a.chat_title,
+            a.last_chat_model,
+            a.created_at AS chat_created_at,
+            a.updated_at AS chat_updated_at,
+            b.name AS user_name,
+            json_extract(m.value, '$.role') AS role,
+            json_extract(m.value, '$.model') AS model,
+            m.key AS message_id,
+            json_extract(m.value, '$.parentId') AS parentId,
+            json_extract(m.value, '$.childrenIds[#-1]') AS last_child_id,
+            0 AS answer_count,
+            0 AS regenerated_count,
+            0 AS failed_count,
+            NULL AS answer_calls,
+            json_extract(m.value, '$.timestamp') AS created_at,{content_columns}
+        FROM a
+        LEFT JOIN user b ON a.user_id = b.id
+        JOIN json_each(a.chat, '$.history.messages') m
+        ORDER BY a.chat_rowid, m.id;
+    """
+    return query_db_chunks(query, engine, chunksize=chunksize, params=params)
+
+def _fetch_chat_ids(engine, since=None, rowid_range=None, excluded_users=DEFAULT_EXCLUDED_USERS) -> pd.DataFrame:
+    """
+    获取会话ID及其 updated_at。不带 since 时用于从增量缓存中剔除已删除的会话，
+    带 since 时用于确定SQL抽取模式下本次读取到的会话。
+    """
+    where, params = _chat_filter(since, rowid_range, excluded_users)
+    return query_db(f"SELECT id, updated_at FROM chat WHERE {where};", engine, params=params)
+
+def _plan_partitions(engine, since=None, partitions: int = 1, excluded_users=DEFAULT_EXCLUDED_USERS) -> list:
+    """
+    将待读取会话的rowid范围等分为若干闭区间，供并行解析使用。
+    """
+    where, params = _chat_filter(since, excluded_users=excluded_users)
+    bounds = query_db(f"SELECT min(rowid) AS lo, max(rowid) AS hi FROM chat WHERE {where};", engine, params=params)
+    lo, hi = bounds.iloc[0]['lo'], bounds.iloc[0]['hi']
+    if pd.isna(lo):
+        return []
+    lo, hi = int(lo), int(hi)
+    step = max((hi - lo + 1 + partitions - 1) // partitions, 1)
+    return [(start, min(start + step - 1, hi)) for start in range(lo, hi + 1, step)]
+
+def _text_metrics(content) -> tuple:
+    """
+    返回消息正文的字符数和UTF-8字节数，非字符串按0计。
+    """
+    if isinstance(content, str):
+        return len(content), len(content.encode('utf-8'))
+    return 0, 0
+
+# 解析结果的列及其存储类型，见 frame_utils.ColumnBuilder。顺序即为DataFrame的列顺序；
+# 正文列按是否为仅统计模式二选一。时间戳列在解析和缓存中保留为Unix秒，返回前统一换算。
+# 会话和消息JSON中的列表字段（models、childrenIds）不保留，只取出统计需要的最后一项
+# （last_chat_model、last_child_id），避免每个单元格都持有一个Python列表
+CHAT_MESSAGE_COLUMNS = {
+    "chat_db_id": 'str',
+    "chat_id": 'str',
+    "chat_user_id": 'str',
+    "chat_title": 'object',
+    "last_chat_model": 'str',
+    "chat_created_at": 'float',
+    "chat_updated_at": 'float',
+    "user_name": 'str',
+    "role": 'str',
+    "model": 'str',
+    "message_id": 'object',
+    "parentId": 'object',
+    "last_child_id": 'object',
+    "answer_count": 'int',
+    "regenerated_count": 'int',
+    "failed_count": 'int',
+    "answer_calls": 'object',
+    "created_at": 'float',
+}
+# answer_count 为以该消息为 parentId 的助手消息数，即该问题触发的推理调用次数；regenerated_count 为其中重新生成的次数：
+# 用户为该问题选择的模型（问题消息的 models，没有时取会话的 models，都没有时为第一个回答的模型）各自的第一个回答不算，
+# 其余回答都算，包括切换到其它模型后重新生成的回答；failed_count 为其中状态不是 ok 的回答数。
+# 三者在整个 history 上统计，与消息范围无关，只抽取当前分支时被丢弃的回答也计入。助手消息三列均为0
+# answer_calls 为各作答模型的回答数、重新生成数和失败数，编码为按模型名排序的JSON：
+# [[模型, 回答数, 重新生成数, 失败数], ...]，没有回答时为空值。
+# 取值种类很少（绝大多数问题只由一个模型回答一次），转换为 category 后每种只保存一份，由 answer_call_entries 展开
+CHAT_TIMESTAMP_COLUMNS = ['chat_created_at', 'chat_updated_at', 'created_at']
+# 返回前转换为 category 类型的低基数列
+CHAT_CATEGORY_COLUMNS = ['chat_id', 'chat_user_id', 'user_name', 'role', 'model', 'last_chat_model', 'answer_model',
+                         'answer_status', 'answer_calls']
+# 按模型别名表统一名称的列；会话按 last_chat_model 匹配排除列表，其余会话中排除列表中的模型作答的回答由 _exclude_answer_models 去掉
+CHAT_MODEL_COLUMNS = ['last_chat_model', 'model', 'answer_model']
+CHAT_CONTENT_COLUMNS = {"content": 'object'}
+CHAT_METRICS_COLUMNS = {"content_length": 'int', "content_bytes": 'int'}
+# 索引配对时附加在问题行后的回答列；没有回答的问题为空值，因此长度列使用浮点数（NaN），与 _create_chat_view 的结果一致。
+# answer_model 为实际作答的模型（助手消息的 model），同时选择多个模型或中途切换模型时可能不同于 last_chat_model；
+# response_latency 为回答与问题的时间戳之差（秒）
+CHAT_ANSWER_COLUMNS = {"answer_message_id": 'object', "answer_model": 'object', "respond_content": 'object',
+                       "response_latency": 'float'}
+CHAT_ANSWER_METRICS_COLUMNS = {"answer_message_id": 'object', "answer_model": 'object',
+                               "respond_content_length": 'float', "respond_content_bytes": 'float',
+                               "response_latency": 'float'}
+# 回答的token用量和生成耗时，取自助手消息的 usage 块（旧版本为 info 块）。OpenAI兼容接口给出
+# prompt_tokens/completion_tokens，Ollama给出 prompt_eval_count/eval_count 以及纳秒级的 eval_duration/total_duration。
+# 时长换算为秒，缺失为 NaN。索引配对时附加在回答列之后，否则附加在每条消息之后（用户消息为 NaN）
+CHAT_USAGE_COLUMNS = {"prompt_tokens": 'float', "completion_tokens": 'float',
+                      "eval_duration": 'float', "total_duration": 'float'}
+# 各用量列依次尝试的键，先在 usage 块中查找，再在 info 块中查找，取第一个非空值
+CHAT_USAGE_KEYS = {
+    "prompt_tokens": ("prompt_tokens", "prompt_eval_count"),
+    "completion_tokens": ("completion_tokens", "eval_count"),
+    "eval_duration": ("eval_duration",),
+    "total_duration": ("total_duration",),
+}
+USAGE_BLOCKS = ("usage", "info")
+# 回答状态，按优先级依次判断：
+#   error    带有 error 字段（值不为 null/false），后端返回了错误
+#   aborted  done 为 false，生成被中断（停止生成、连接断开等）
+#   empty    正文不是字符串，或去掉空白后为空
+#   ok       正常回答
+ANSWER_STATUSES = ('ok', 'error', 'aborted', 'empty')
+# 去除的空白字符，与SQL抽取路径中 trim 使用的字符一致
+_BLANK_CHARACTERS = " \t\n\r"
+# 回答状态列：索引配对时为所配回答的状态（没有回答的问题为空），否则为每条助手消息自身的状态（用户消息为空）
+CHAT_ANSWER_STATUS_COLUMNS = {"answer_status": 'str'}
+# 属于回答的列：索引配对时附加在回答列之后，否则附加在每条消息之后
+CHAT_ANSWER_ATTRIBUTE_COLUMNS = {**CHAT_USAGE_COLUMNS, **CHAT_ANSWER_STATUS_COLUMNS}
+# 以纳秒为单位的用量列
+CHAT_USAGE_NANOSECOND_COLUMNS = ["eval_duration", "total_duration"]
+
+def _active_branch(current_id, parent_of: dict) -> set:
+    """
+    从 current_id 沿 parentId 回溯到根消息，返回当前分支上的消息ID。
+    currentId 缺失或不在消息中时返回空集合。
+
+    Args:
+        current_id: 会话的 history.currentId。
+        parent_of (dict): {消息ID: parentId}。
+    """
+    branch = set()
+    message_id = current_id
+    # 遇到环时停止，避免异常数据导致死循环
+    while message_id is not None and message_id in parent_of and message_id not in branch:
+        branch.add(message_id)
+        message_id = parent_of[message_id]
+    return branch
+
+def _message_columns(metrics_only: bool, pairing: str) -> dict:
+    """
+    返回解析结果的列定义：消息字段、正文列，以及索引配对时的回答列。
+    """
+    columns = {**CHAT_MESSAGE_COLUMNS, **(CHAT_METRICS_COLUMNS if metrics_only else CHAT_CONTENT_COLUMNS)}
+    if pairing == 'index':
+        columns.update(CHAT_ANSWER_METRICS_COLUMNS if metrics_only else CHAT_ANSWER_COLUMNS)
+    columns.update(CHAT_ANSWER_ATTRIBUTE_COLUMNS)
+    return columns
+
+def _answer_rank(timestamp) -> float:
+    """
+    回答的新旧排序键，没有时间戳的回答排在最后。排序键相同时取 history.messages 中靠后的回答
+    （界面按创建顺序写入消息，靠后的即后生成的，与其在问题 childrenIds 中的位置一致），
+    各配对方式都按这一规则选择，与 _create_chat_view 中的稳定排序一致。
+    """
+    try:
+        rank = float(timestamp)
+    except (TypeError, ValueError):
+        return float('-inf')
+    # SQL抽取路径中缺失的时间戳为 NaN，与 None 同样排在最后
+    return float('-inf') if np.isnan(rank) else rank
+
+def _response_latency(query_timestamp, answer_timestamp) -> float:
+    """
+    回答耗时（秒）：回答与问题的时间戳之差，任一时间戳缺失时为 NaN。
+    """
+    try:
+        return float(answer_timestamp) - float(query_timestamp)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def _usage_metrics(message) -> tuple:
+    """
+    按 CHAT_USAGE_COLUMNS 的顺序返回消息的token用量和生成耗时（秒），缺失为 None。
+    与SQL抽取路径中的 COALESCE 顺序一致：usage 块优先于 info 块，同一块内按 CHAT_USAGE_KEYS 的顺序。
+    """
+    blocks = [block for block in (message.get(name) for name in USAGE_BLOCKS) if isinstance(block, dict)]
+    values = []
+    for column, keys in CHAT_USAGE_KEYS.items():
+        value = next((block[key] for block in blocks for key in keys if block.get(key) is not None), None)
+        if value is not None and column in CHAT_USAGE_NANOSECOND_COLUMNS:
+            try:
+                value = float(value) / 1e9
+            except (TypeError, ValueError):
+                value = None
+        values.append(value)
+    return tuple(values)
+
+_NO_USAGE = (None,) * len(CHAT_USAGE_COLUMNS)
+
+def _answer_status(message) -> str:
+    """
+    判断助手消息的状态，见 ANSWER_STATUSES。
+    """
+    error = message.get("error")
+    if error is not None and error is not False:
+        return 'error'
+    if message.get("done") is False:
+        return 'aborted'
+    content = message.get("content")
+    if not isinstance(content, str) or not content.strip(_BLANK_CHARACTERS):
+        return 'empty'
+    return 'ok'
+
+def _picked_models(question_models, chat_models):
+    """
+    返回用户为问题选择的模型列表：优先取问题消息的 models（同时选择多个模型时每个模型各回答一次），
+    没有时取会话的 models，都没有时返回 None。
+    """
+    for models in (question_models, chat_models):
+        if isinstance(models, list) and models:
+            return models
+    return None
+
+def _model_calls(answers, picked_models) -> dict:
+    """
+    按作答模型汇总一个问题的回答，返回 {模型: (回答数, 重新生成数, 失败数)}。
+    所选模型各自的第一个回答是正常的推理调用，其余回答都计为重新生成，切换到未选择的模型后重新生成的回答也计入；
+    picked_models 为 None 时视为只选择了第一个回答（按 history 中的顺序）的模型。
+
+    Args:
+        answers: 问题的各回答的 (模型, 状态)，按 history 中的顺序。
+        picked_models (list | None): _picked_models 的结果。
+    """
+    if picked_models is None:
+        picked_models = [answers[0][0]]
+    calls = {}
+    for model, status in answers:
+        count, failed = calls.get(model, (0, 0))
+        calls[model] = (count + 1, failed + (status != 'ok'))
+    return {model: (count, count - (model in picked_models), failed)
+            for model, (count, failed) in calls.items()}
+
+def _encode_answer_calls(calls: dict) -> str:
+    """
+    将 _model_calls 的结果编码为 answer_calls 的取值。按模型名排序（没有模型字段的排在最后），
+    同样的回答组合总是得到同一个字符串。
+    """
+    entries = sorted(([model, int(count), int(regenerated), int(failed)]
+                      for model, (count, regenerated, failed) in calls.items()),
+                     key=lambda entry: (entry[0] is None, str(entry[0])))
+    return json.dumps(entries, ensure_ascii=False, separators=(',', ':'))
+
+def answer_call_entries(answer_calls: pd.Series) -> pd.DataFrame:
+    """
+    把 category 类型的 answer_calls 列展开为每个 (问题, 作答模型) 一行的DataFrame。
+    每种取值只解码一次，再按类别编码与各行连接。
+
+    Returns:
+        pd.DataFrame: position（问题在 answer_calls 中的行位置）、answer_model、calls、regenerated、failed 五列。
+    """
+    entries = pd.DataFrame(
+        [(code, *entry) for code, category in enumerate(answer_calls.cat.categories)
+         for entry in json.loads(category)],
+        columns=['code', 'answer_model', 'calls', 'regenerated', 'failed'])
+    rows = pd.DataFrame({'code': answer_calls.cat.codes.to_numpy(), 'position': np.arange(len(answer_calls))})
+    return rows.merge(entries, on='code').drop(columns='code')
+
+def _recode_answer_calls(answer_calls: pd.Series, aliases: dict) -> pd.Series:
+    """
+    按模型别名表重命名 answer_calls 中的模型，映射到同一名称的模型各项计数相加。只处理类别。
+    """
+    mapping = {}
+    for category in answer_calls.cat.categories:
+        calls = {}
+        for model, *counts in json.loads(category):
+            model = aliases.get(model, model)
+            calls[model] = tuple(a + b for a, b in zip(calls.get(model, (0, 0, 0)), counts))
+        mapping[category] = _encode_answer_calls(calls)
+    return recode_categories(answer_calls, mapping)
+
+def _exclude_answer_models(chat_df: pd.DataFrame, excluded) -> pd.DataFrame:
+    """
+    从问答对中去掉排除列表中的模型作答的回答，会话级的排除（last_chat_model）由 apply_model_alias_table 完成。
+    所配回答来自这些模型的问题，回答列置为空值，视为没有回答；answer_calls 中去掉这些模型的条目，
+    answer_count、regenerated_count、failed_count 减去相应的计数。answer_calls 只在类别上处理。
+    """
+    if 'answer_model' not in chat_df.columns or not excluded:
+        return chat_df
+    masked = chat_df['answer_model'].isin(excluded).to_numpy()
+    if masked.any():
+        answer_columns = [col for col in {**CHAT_ANSWER_COLUMNS, **CHAT_ANSWER_METRICS_COLUMNS,
+                                          **CHAT_ANSWER_ATTRIBUTE_COLUMNS} if col in chat_df.columns]
+        chat_df.loc[masked, answer_columns] = None
+        logger.info(f"按模型排除列表去掉 {int(masked.sum())} 个问题的回答（answer_model）")
+    present = [model for model in excluded if model in chat_df['answer_model'].cat.categories]
+    chat_df['answer_model'] = chat_df['answer_model'].cat.remove_categories(present)
+
+    if 'answer_calls' not in chat_df.columns:
+        return chat_df
+    answer_calls = chat_df['answer_calls']
+    mapping = {}
+    # 每个类别中被去掉的 (回答数, 重新生成数, 失败数)，末尾一行对应缺失值的编码 -1
+    removed = np.zeros((len(answer_calls.cat.categories) + 1, 3), dtype='int64')
+    for code, category in enumerate(answer_calls.cat.categories):
+        calls = {}
+        for model, *counts in json.loads(category):
+            if model in excluded:
+                removed[code] += counts
+            else:
+                calls[model] = counts
+        mapping[category] = _encode_answer_calls(calls)
+    removed = removed[answer_calls.cat.codes.to_numpy()]
+    for i, column in enumerate(['answer_count', 'regenerated_count', 'failed_count']):
+        chat_df[column] = chat_df[column] - removed[:, i]
+    # 全部条目都被去掉的问题与没有回答的问题一样为空值
+    answer_calls = recode_categories(answer_calls, mapping)
+    empty = _encode_answer_calls({})
+    if empty in answer_calls.cat.categories:
+        answer_calls = answer_calls.cat.remove_categories([empty])
+    chat_df['answer_calls'] = answer_calls
+    return chat_df
+
+def _answer_counts(answers, picked_models) -> tuple:
+    """
+    返回 (answer_count, regenerated_count, failed_count, answer_calls)。
+
+    Args:
+        answers: 问题的各回答的 (模型, 状态)，没有回答时为 None。
+        picked_models (list | None): _picked_models 的结果。
+    """
+    if not answers:
+        return 0, 0, 0, None
+    calls = _model_calls(answers, picked_models)
+    return (len(answers), sum(regenerated for _, regenerated, _ in calls.values()),
+            sum(failed for _, _, failed in calls.values()), _encode_answer_calls(calls))
+
+def _parse_chat_messages(chat_df: pd.DataFrame, metrics_only: bool = False, branch_mode: str = 'all',
+                         pairing: str = 'index') -> pd.DataFrame:
     """
     解析原始聊天DataFrame，提取消息级别的数据。
+    每条消息的字段直接追加到各列中，最后由列构造DataFrame。
+
+    Args:
+        chat_df (pd.DataFrame): 原始chat记录块。
+        metrics_only (bool): 为 True 时不保留消息正文，只记录 content_length（字符数）
+            和 content_bytes（UTF-8字节数）。
+        branch_mode (str): 'all' 输出全部消息；'active' 只输出当前分支（history.currentId 及其祖先）上的消息。
+        pairing (str): 'index' 在解析每个会话时建立 parentId -> 最新回答 的索引，直接输出问答对
+            （每个用户问题一行，附带 answer_message_id、作答模型 answer_model、回答正文/长度、回答耗时 response_latency、
+            回答的token用量和状态），结果与 _create_chat_view 相同；
+            'pandas' 输出全部消息，由 _create_chat_view 配对。
     """
-    chat_data = []
-    
-    def timestamp_to_datetime(timestamp):
-        if timestamp is None:
-            return None
-        return datetime.datetime.fromtimestamp(timestamp)
+    builder = ColumnBuilder(_message_columns(metrics_only, pairing))
+    add_row = builder.add_row
+    index_pairing = pairing == 'index'
 
     for _, r in chat_df.iterrows():
         try:
-            chat_ = json.loads(r['chat'])
+            chat_ = json_codec.decode_chat(r['chat'])
+            chat_db_id = r['id']
             user_id = r['user_id']
             user_name = r.get('name')
-            
-            if user_name in ['dali', 'cz', ' cz']:
-                continue
 
             chat_model = chat_.get("models", [])
             chat_title = chat_.get("title")
             chat_id = chat_.get("id")
+            last_chat_model = chat_model[-1] if chat_model else None
+            chat_created_at = r['created_at']
+            chat_updated_at = r['updated_at']
+
+            history = chat_.get("history", {})
+            messages = history.get("messages", {})
+            if branch_mode == 'active':
+                branch = _active_branch(history.get("currentId"),
+                                        {msg_id: hist.get("parentId") for msg_id, hist in messages.items()})
+
+            # parentId -> 各回答的 (模型, 状态)，用于统计重新生成和失败；
+            # 索引配对时同时建立 parentId -> (排序键, 回答ID, 回答)，同一问题的多个回答只保留最新的一个
+            answer_models = {}
+            statuses = {}
+            answers = {}
+            for msg_id, hist in messages.items():
+                if hist.get("role") != "assistant":
+                    continue
+                parent_id = hist.get("parentId")
+                status = statuses[msg_id] = _answer_status(hist)
+                answer_models.setdefault(parent_id, []).append((hist.get("model"), status))
+                if not index_pairing or (branch_mode == 'active' and msg_id not in branch):
+                    continue
+                rank = _answer_rank(hist.get("timestamp"))
+                latest = answers.get(parent_id)
+                if latest is None or rank >= latest[0]:
+                    answers[parent_id] = (rank, msg_id, hist)
 
-            for msg_id, hist in chat_.get("history", {}).get("messages", {}).items():
-                chat_data.append({
-                    "chat_id": chat_id,
-                    "chat_user_id": user_id,
-                    "chat_title": chat_title,
-                    "chat_model": chat_model,
-                    "last_chat_model": chat_model[-1] if chat_model else None,
-                    "chat_created_at": timestamp_to_datetime(r['created_at']),
-                    "chat_updated_at": timestamp_to_datetime(r['updated_at']),
-                    "user_name": user_name,
-                    "role": hist.get("role"),
-                    "model": hist.get("model"),
-                    "models": hist.get("models"),
-                    "message_id": msg_id,
-                    "parentId": hist.get("parentId"),
-                    "last_child_id": hist.get("childrenIds", [])[-1] if hist.get("childrenIds") else None,
-                    "childrenIds": hist.get("childrenIds"),
-                    "created_at": timestamp_to_datetime(hist.get("timestamp")),
-                    "content": hist.get("content")
-                })
-        except (json.JSONDecodeError, KeyError) as e:
+            for msg_id, hist in messages.items():
+                if branch_mode == 'active' and msg_id not in branch:
+                    continue
+                role = hist.get("role")
+                if index_pairing and role != "user":
+                    continue
+                children_ids = hist.get("childrenIds")
+                content = hist.get("content")
+                timestamp = hist.get("timestamp")
+                row = (
+                    chat_db_id, chat_id, user_id, chat_title, last_chat_model,
+                    chat_created_at, chat_updated_at, user_name,
+                    role,
+                    hist.get("model"),
+                    msg_id,
+                    hist.get("parentId"),
+                    children_ids[-1] if children_ids else None,
+                    *_answer_counts(answer_models.get(msg_id), _picked_models(hist.get("models"), chat_model)),
+                    timestamp,
+                )
+                row += _text_metrics(content) if metrics_only else (content,)
+                if index_pairing:
+                    latest = answers.get(msg_id)
+                    if latest is None:
+                        row += (None, None, None, None, None) if metrics_only else (None, None, None, None)
+                        row += (*_NO_USAGE, None)
+                    else:
+                        _, answer_id, answer = latest
+                        answer_content = answer.get("content")
+                        row += (answer_id, answer.get("model"), *_text_metrics(answer_content)) if metrics_only \
+                            else (answer_id, answer.get("model"), answer_content)
+                        row += (_response_latency(timestamp, answer.get("timestamp")),)
+                        row += (*_usage_metrics(answer), statuses[answer_id])
+                else:
+                    row += (*_usage_metrics(hist), statuses.get(msg_id))
+                add_row(*row)
+        except (*json_codec.JSON_DECODE_ERRORS, KeyError) as e:
             logger.warning(f"解析chat记录时出错 (ID: {r.get('id', 'N/A')}): {e}")
             continue
 
-    return pd.DataFrame(chat_data)
+    return builder.to_frame()
 
-def _create_chat_view(chat_data_pd: pd.DataFrame) -> pd.DataFrame:
+def _create_chat_view(chat_data_pd: pd.DataFrame, latest_answer_only: bool = True) -> pd.DataFrame:
     """
     将用户问题和助手回答配对，创建用于展示的DataFrame。
+
+    Args:
+        chat_data_pd (pd.DataFrame): 消息级数据。
+        latest_answer_only (bool): 一个问题有多个回答（重新生成）时只保留最新的一个。
+            只抽取当前分支时每个问题至多一个回答，可以传入 False 跳过排序和去重。
     """
     if chat_data_pd.empty:
         return pd.DataFrame()
 
-    queries = chat_data_pd[chat_data_pd.role == "user"].copy()
+    # token用量、状态等属于回答，从问题行中去掉，随回答一起合并进来
+    usage_columns = [col for col in CHAT_ANSWER_ATTRIBUTE_COLUMNS if col in chat_data_pd.columns]
+    queries = chat_data_pd[chat_data_pd.role == "user"].drop(columns=usage_columns)
     responses = chat_data_pd[chat_data_pd.role == "assistant"].copy()
     
-    # 准备用于合并的回答数据。我们只需要 parentId（作为连接键）和 content。
-    # 我们还包括 created_at 时间戳，以便在有多个回答时选择最新的一个。
-    responses_to_merge = responses[['parentId', 'content','message_id', 'created_at']].copy()
+    # 准备用于合并的回答数据。我们只需要 parentId（作为连接键）和 content
+    # （仅统计模式下为 content_length 和 content_bytes）。
+    # 我们还包括 created_at 时间戳，以便在有多个回答时选择最新的一个，并计算回答耗时。
+    text_columns = [col for col in ['content', 'content_length', 'content_bytes'] if col in responses.columns]
+    responses_to_merge = responses[['parentId', *text_columns, 'message_id', 'model', 'created_at',
+                                    *usage_columns]].copy()
     responses_to_merge.rename(columns={
         'parentId': 'message_id', 
         'message_id':'answer_message_id',
-        'content': 'respond_content'
+        'model': 'answer_model',
+        'created_at': 'answer_created_at',
+        **{col: f'respond_{col}' for col in text_columns}
     }, inplace=True)
 
     # 如果一个问题有多个回答，只保留最新的一个。
-    # 按时间降序排序，然后根据 message_id 删除重复项，保留第一个（即最新的）。
-    responses_to_merge.sort_values('created_at', ascending=False, inplace=True)
-    responses_to_merge.drop_duplicates(subset=['message_id'], keep='first', inplace=True)
+    # 按时间升序稳定排序（没有时间的排在最前），然后根据 message_id 删除重复项，保留最后一个（即最新的）；
+    # 时间相同的回答保持消息顺序，取靠后的一个，与 _answer_rank 的规则一致。
+    if latest_answer_only:
+        responses_to_merge.sort_values('answer_created_at', kind='stable', na_position='first', inplace=True)
+        responses_to_merge.drop_duplicates(subset=['message_id'], keep='last', inplace=True)
     
     # on='message_id' 将会连接 queries.message_id 和 responses_to_merge.message_id (原 parentId)
     chat_show_data = queries.merge(
-        responses_to_merge[['message_id','answer_message_id', 'respond_content']], 
+        responses_to_merge[['message_id','answer_message_id', 'answer_model',
+                            *[f'respond_{col}' for col in text_columns],
+                            'answer_created_at', *usage_columns]], 
         on='message_id',
         how='left' # 使用left join保留所有问题，即使没有回答
     )
+    # 回答耗时（秒）
+    answer_created_at = chat_show_data.pop('answer_created_at')
+    chat_show_data['response_latency'] = (answer_created_at - chat_show_data['created_at']).dt.total_seconds()
+    # 与索引配对的列顺序一致，属于回答的列放在最后
+    for col in usage_columns:
+        chat_show_data[col] = chat_show_data.pop(col)
     
     chat_show_data.reset_index(drop=True, inplace=True)
     return chat_show_data
 
-def get_chat_data(db_path: str) -> pd.DataFrame:
+def _fingerprint(blob) -> str:
+    """
+    计算会话JSON的内容指纹。
+    """
+    if isinstance(blob, str):
+        blob = blob.encode('utf-8')
+    return hashlib.blake2b(blob, digest_size=16).hexdigest()
+
+def _parse_chunks(chunks, metrics_only: bool = False, known_fingerprints: dict = None,
+                  branch_mode: str = 'all', pairing: str = 'index') -> _Extraction:
+    """
+    逐块解析原始会话。每块解析完后原始JSON即被释放，内存中只保留解析结果。
+
+    Args:
+        chunks: _fetch_raw_chat_data 返回的原始记录块。
+        metrics_only (bool): 见 _parse_chat_messages。
+        branch_mode (str): 见 _parse_chat_messages。
+        pairing (str): 见 _parse_chat_messages。
+        known_fingerprints (dict, optional): 增量模式下缓存中的 {会话ID: 指纹}。传入时为每个会话计算指纹，
+            指纹未变的会话（例如只改了标签，updated_at 被刷新）不再重新解析，沿用缓存中的消息。
+    """
+    parsed_chunks = []
+    fetched_ids = []
+    fingerprints = {}
+    unchanged = {}
+    total = 0
+    max_updated_at = None
+    for raw_chunk in chunks:
+        if raw_chunk.empty:
+            continue
+        total += len(raw_chunk)
+        chunk_max = int(raw_chunk['updated_at'].max())
+        max_updated_at = chunk_max if max_updated_at is None else max(max_updated_at, chunk_max)
+        if known_fingerprints is not None:
+            chunk_fingerprints = raw_chunk['chat'].map(_fingerprint)
+            same = chunk_fingerprints == raw_chunk['id'].map(known_fingerprints)
+            unchanged.update(zip(raw_chunk.loc[same, 'id'], raw_chunk.loc[same, 'updated_at']))
+            fingerprints.update(zip(raw_chunk.loc[~same, 'id'], chunk_fingerprints[~same]))
+            raw_chunk = raw_chunk[~same]
+        fetched_ids.extend(raw_chunk['id'])
+        parsed = _parse_chat_messages(raw_chunk, metrics_only, branch_mode, pairing)
+        if not parsed.empty:
+            parsed_chunks.append(parsed)
+    logger.info(f"成功读取chat表数据，共 {total} 条记录")
+    if unchanged:
+        logger.info(f"其中 {len(unchanged)} 个会话内容指纹未变，跳过解析")
+    parsed_df = pd.concat(parsed_chunks, ignore_index=True) if parsed_chunks else pd.DataFrame()
+    return _Extraction(parsed_df, fetched_ids, max_updated_at, fingerprints, unchanged)
+
+def _convert_sql_messages(messages_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    将SQL抽取的消息块转换为与 _parse_chat_messages 相同的列类型。
+    """
+    for col in [*CHAT_TIMESTAMP_COLUMNS, *CHAT_USAGE_COLUMNS]:
+        messages_df[col] = pd.to_numeric(messages_df[col], errors='coerce').astype('float64')
+    for col in CHAT_USAGE_NANOSECOND_COLUMNS:
+        messages_df[col] = messages_df[col] / 1e9
+    return messages_df
+
+def _count_answers(messages_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    SQL抽取模式下填充 answer_count、regenerated_count、failed_count 和 answer_calls 列（SQL中为占位的0和NULL），
+    并去掉 picked_models 列。按 (会话, parentId) 收集助手消息的 (模型, 状态)，与Python解析路径使用同一套计数规则，
+    需在筛选当前分支之前、所有块拼接之后调用。
+    """
+    answers = {}
+    is_answer = (messages_df['role'] == "assistant").to_numpy()
+    for chat_db_id, parent_id, model, status in zip(
+            messages_df['chat_db_id'].to_numpy()[is_answer], messages_df['parentId'].to_numpy()[is_answer],
+            messages_df['model'].to_numpy()[is_answer], messages_df['answer_status'].to_numpy()[is_answer]):
+        answers.setdefault((chat_db_id, parent_id), []).append((None if pd.isna(model) else model, status))
+    counts = [
+        _answer_counts(answers.get((chat_db_id, message_id)),
+                       json_codec.loads(picked) if isinstance(picked, str) else None)
+        for chat_db_id, message_id, picked in zip(
+            messages_df['chat_db_id'], messages_df['message_id'], messages_df.pop('picked_models'))
+    ]
+    for i, column in enumerate(['answer_count', 'regenerated_count', 'failed_count', 'answer_calls']):
+        values = [row[i] for row in counts]
+        messages_df[column] = values if column == 'answer_calls' else np.asarray(values, dtype='int64')
+    return messages_df
+
+def _filter_active_branch(messages_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    SQL抽取模式下按 current_id 列筛选每个会话当前分支上的消息，并去掉 current_id 列。
+    一个会话的消息可能分布在多个块中，因此在所有块拼接后再筛选。
+    """
+    parents = {}
+    current_ids = {}
+    for chat_db_id, message_id, parent_id, current_id in zip(
+            messages_df['chat_db_id'], messages_df['message_id'], messages_df['parentId'], messages_df['current_id']):
+        parents.setdefault(chat_db_id, {})[message_id] = parent_id
+        current_ids[chat_db_id] = current_id
+    branches = {chat_db_id: _active_branch(current_ids[chat_db_id], parent_of)
+                for chat_db_id, parent_of in parents.items()}
+    mask = [message_id in branches[chat_db_id]
+            for chat_db_id, message_id in zip(messages_df['chat_db_id'], messages_df['message_id'])]
+    return messages_df.loc[mask].drop(columns='current_id').reset_index(drop=True)
+
+def _pair_messages(messages_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    SQL抽取模式下的索引配对：一次遍历建立 (会话, parentId) -> 最新回答所在行 的索引，
+    再为每个用户问题取出对应回答的列，结果与 _parse_chat_messages 的索引配对相同。
+    """
+    latest = {}
+    for position, (chat_db_id, role, parent_id, timestamp) in enumerate(zip(
+            messages_df['chat_db_id'], messages_df['role'], messages_df['parentId'], messages_df['created_at'])):
+        if role != "assistant":
+            continue
+        key = (chat_db_id, parent_id)
+        rank = _answer_rank(timestamp)
+        if key not in latest or rank >= latest[key][0]:
+            latest[key] = (rank, position)
+
+    usage_columns = list(CHAT_ANSWER_ATTRIBUTE_COLUMNS)
+    is_query = (messages_df['role'] == "user").to_numpy()
+    queries = messages_df[is_query].drop(columns=usage_columns).reset_index(drop=True)
+    answer_positions = [latest[key][1] if key in latest else -1
+                        for key in zip(queries['chat_db_id'], queries['message_id'])]
+    text_columns = [col for col in ['content', 'content_length', 'content_bytes'] if col in messages_df.columns]
+    # messages_df 的索引是 0..n-1，位置 -1 不存在，reindex 后即为空值
+    answers = messages_df[['message_id', 'model', *text_columns, 'created_at', *usage_columns]] \
+        .reindex(answer_positions).reset_index(drop=True)
+    answers.columns = ['answer_message_id', 'answer_model', *[f'respond_{col}' for col in text_columns],
+                       'answer_created_at', *usage_columns]
+    latency = answers.pop('answer_created_at') - queries['created_at']
+    answers.insert(len(answers.columns) - len(usage_columns), 'response_latency', latency)
+    return pd.concat([queries, answers], axis=1)
+
+def _extract_messages_sql(engine, since=None, chunksize: int = DEFAULT_CHUNKSIZE, metrics_only: bool = False,
+                          rowid_range=None, excluded_users=DEFAULT_EXCLUDED_USERS,
+                          branch_mode: str = 'all', pairing: str = 'index') -> _Extraction:
+    """
+    SQL抽取模式：消息在数据库内展开，Python只做少量类型转换。
+    会话JSON不经过Python，因此不计算内容指纹，读取到的会话都会重新解析。
+    """
+    fetched = _fetch_chat_ids(engine, since, rowid_range, excluded_users)
+    parsed_chunks = []
+    for chunk in _fetch_chat_messages_sql(engine, since=since, chunksize=chunksize, metrics_only=metrics_only,
+                                          rowid_range=rowid_range, excluded_users=excluded_users,
+                                          branch_mode=branch_mode):
+        if not chunk.empty:
+            parsed_chunks.append(_convert_sql_messages(chunk))
+    logger.info(f"成功读取chat表数据，共 {len(fetched)} 条记录")
+    parsed_df = pd.concat(parsed_chunks, ignore_index=True) if parsed_chunks else pd.DataFrame()
+    if not parsed_df.empty:
+        parsed_df = _count_answers(parsed_df)
+    if branch_mode == 'active' and not parsed_df.empty:
+        parsed_df = _filter_active_branch(parsed_df)
+    if pairing == 'index' and not parsed_df.empty:
+        parsed_df = _pair_messages(parsed_df)
+    max_updated_at = int(fetched['updated_at'].max()) if not fetched.empty else None
+    return _Extraction(parsed_df, list(fetched['id']), max_updated_at, {}, {})
+
+def _extract_messages(engine, since=None, chunksize: int = DEFAULT_CHUNKSIZE, extract_mode: str = 'python',
+                      metrics_only: bool = False, rowid_range=None, known_fingerprints: dict = None,
+                      excluded_users=DEFAULT_EXCLUDED_USERS, branch_mode: str = 'all',
+                      pairing: str = 'index') -> _Extraction:
+    """
+    按指定的抽取方式读取并解析消息级数据。
+    """
+    if extract_mode not in EXTRACT_MODES:
+        raise ValueError(f"不支持的抽取方式: {extract_mode}，可选: {EXTRACT_MODES}")
+    if branch_mode not in BRANCH_MODES:
+        raise ValueError(f"不支持的消息范围: {branch_mode}，可选: {BRANCH_MODES}")
+    if pairing not in PAIRING_MODES:
+        raise ValueError(f"不支持的问答配对方式: {pairing}，可选: {PAIRING_MODES}")
+    if extract_mode == 'sql':
+        return _extract_messages_sql(engine, since=since, chunksize=chunksize, metrics_only=metrics_only,
+                                     rowid_range=rowid_range, excluded_users=excluded_users,
+                                     branch_mode=branch_mode, pairing=pairing)
+    return _parse_chunks(_fetch_raw_chat_data(engine, since=since, chunksize=chunksize, rowid_range=rowid_range,
+                                              excluded_users=excluded_users),
+                         metrics_only, known_fingerprints, branch_mode, pairing)
+
+def _extract_partition(db_path: str, rowid_range, json_decoder: str, options: dict):
+    """
+    并行解析的worker入口：在子进程中打开自己的引擎，解析一个rowid区间内的会话。
+    """
+    json_codec.set_decoder(json_decoder)
+    engine = get_db_engine(db_path, read_only=True)
+    return _extract_messages(engine, rowid_range=rowid_range, **options)
+
+def _extract_messages_parallel(db_path: str, engine, workers: int, **options) -> _Extraction:
+    """
+    按rowid区间切分会话，在进程池中并行解析，再按区间顺序拼接结果。
+    区间有序且每个区间内部按rowid排序，因此结果与串行解析完全一致。
+    """
+    partitions = _plan_partitions(engine, options.get('since'), workers * PARTITIONS_PER_WORKER,
+                                  options.get('excluded_users', DEFAULT_EXCLUDED_USERS))
+    logger.info(f"使用 {workers} 个进程并行解析 {len(partitions)} 个rowid区间")
+    parsed_chunks = []
+    fetched_ids = []
+    fingerprints = {}
+    unchanged = {}
+    max_updated_at = None
+    # fork出的子进程会继承父进程的引擎注册表，先丢弃继承的连接池，避免与父进程共用同一个SQLite连接
+    with ProcessPoolExecutor(max_workers=workers, initializer=reset_engines_after_fork) as executor:
+        futures = [
+            executor.submit(_extract_partition, db_path, rowid_range, json_codec.decoder_name(), options)
+            for rowid_range in partitions
+        ]
+        # 按提交顺序取结果，保证输出顺序确定
+        for future in futures:
+            result = future.result()
+            if not result.parsed_df.empty:
+                parsed_chunks.append(result.parsed_df)
+            fetched_ids.extend(result.fetched_ids)
+            fingerprints.update(result.fingerprints)
+            unchanged.update(result.unchanged)
+            if result.max_updated_at is not None:
+                max_updated_at = result.max_updated_at if max_updated_at is None \
+                    else max(max_updated_at, result.max_updated_at)
+    parsed_df = pd.concat(parsed_chunks, ignore_index=True) if parsed_chunks else pd.DataFrame()
+    return _Extraction(parsed_df, fetched_ids, max_updated_at, fingerprints, unchanged)
+
+def _merge_incremental(cached_df: pd.DataFrame, parsed_df: pd.DataFrame,
+                       fetched_ids, live_ids, unchanged: dict = None) -> pd.DataFrame:
+    """
+    将本次增量解析的消息合并进缓存：本次读取到的会话整体替换缓存中的旧消息，
+    已从数据库删除的会话从缓存中剔除；内容未变的会话只刷新 chat_updated_at。
+    """
+    if cached_df.empty:
+        return parsed_df
+    if unchanged:
+        touched = cached_df['chat_db_id'].map(unchanged)
+        mask = touched.notna()
+        cached_df = cached_df.copy()
+        cached_df.loc[mask, 'chat_updated_at'] = touched[mask].astype('float64')
+    keep = ~cached_df['chat_db_id'].isin(fetched_ids) & cached_df['chat_db_id'].isin(live_ids)
+    frames = [df for df in (cached_df[keep], parsed_df) if not df.empty]
+    if not frames:
+        return parsed_df
+    # 与全量抽取一样，拼接后统一推断一次列类型（例如本次解析的会话 parentId 全为空时会被推断为 object）
+    return pd.concat(frames, ignore_index=True).infer_objects()
+
+def _load_parsed_messages(db_path: str, incremental: bool, cache_dir=None,
+                          chunksize: int = DEFAULT_CHUNKSIZE, extract_mode: str = 'python',
+                          metrics_only: bool = False, workers: int = 1,
+                          excluded_users=DEFAULT_EXCLUDED_USERS, branch_mode: str = 'all',
+                          pairing: str = 'index') -> pd.DataFrame:
+    """
+    读取并解析消息级数据（索引配对时为问答对）。增量模式下只解析水位线之后更新过的会话，并与缓存合并。
+    """
+    engine = get_db_engine(db_path, read_only=True)
+
+    def extract(since=None, known_fingerprints=None) -> _Extraction:
+        options = dict(since=since, chunksize=chunksize, extract_mode=extract_mode, metrics_only=metrics_only,
+                       known_fingerprints=known_fingerprints, excluded_users=excluded_users,
+                       branch_mode=branch_mode, pairing=pairing)
+        if workers > 1:
+            result = _extract_messages_parallel(db_path, engine, workers, **options)
+        else:
+            result = _extract_messages(engine, **options)
+        # 各块单独推断的列类型可能不同（例如某块的用户名全为空），拼接后统一推断一次，
+        # 使结果的类型与分块和并行方式无关
+        return result._replace(parsed_df=result.parsed_df.infer_objects())
+
+    if not incremental:
+        return extract().parsed_df
+
+    cache_name = CHAT_METRICS_CACHE_NAME if metrics_only else CHAT_CACHE_NAME
+    fingerprint_cache_name = f"{cache_name}_fingerprints"
+    # 排除的用户或消息范围变化后，缓存中的消息不再对应当前的过滤条件，需要全量重建
+    cache_params = {'excluded_users': sorted(set(excluded_users)), 'branch_mode': branch_mode, 'pairing': pairing}
+    watermark, cached_df = load_cache(cache_name, CHAT_CACHE_VERSION, cache_dir, cache_params)
+    _, fingerprint_df = load_cache(fingerprint_cache_name, CHAT_CACHE_VERSION, cache_dir, cache_params)
+    if cached_df is None or fingerprint_df is None:
+        watermark = None
+        cached_df = None
+        fingerprint_df = pd.DataFrame(columns=['chat_db_id', 'fingerprint'])
+    fingerprints = dict(zip(fingerprint_df['chat_db_id'], fingerprint_df['fingerprint']))
+
+    # 只把本次要读取的会话的指纹交给解析过程，并行解析时不必把全部指纹发给每个进程
+    candidate_ids = _fetch_chat_ids(engine, watermark, excluded_users=excluded_users)['id'] \
+        if watermark is not None else []
+    known_fingerprints = {chat_id: fingerprints[chat_id] for chat_id in candidate_ids if chat_id in fingerprints}
+    result = extract(since=watermark, known_fingerprints=known_fingerprints)
+    parsed_df = result.parsed_df
+
+    live_ids = _fetch_chat_ids(engine, excluded_users=excluded_users)['id']
+    if cached_df is not None:
+        parsed_df = _merge_incremental(cached_df, parsed_df, result.fetched_ids, live_ids, result.unchanged)
+        logger.info(f"增量解析 {len(result.fetched_ids)} 个会话，合并后共 {len(parsed_df)} 条消息")
+
+    fingerprints.update(result.fingerprints)
+    live = set(live_ids)
+    fingerprint_df = pd.DataFrame(
+        [(chat_id, fingerprint) for chat_id, fingerprint in fingerprints.items() if chat_id in live],
+        columns=['chat_db_id', 'fingerprint'])
+
+    if result.max_updated_at is not None:
+        watermark = result.max_updated_at
+    save_cache(cache_name, CHAT_CACHE_VERSION, watermark, parsed_df, cache_dir, cache_params)
+    save_cache(fingerprint_cache_name, CHAT_CACHE_VERSION, watermark, fingerprint_df, cache_dir, cache_params)
+    return parsed_df
+
+def get_chat_data(db_path: str, incremental: bool = False, cache_dir=None,
+                  chunksize: int = DEFAULT_CHUNKSIZE, extract_mode: str = 'python',
+                  metrics_only: bool = False, workers: int = 1, timezone: str = DEFAULT_TIMEZONE,
+                  excluded_users=None, branch_mode: str = 'all', pairing: str = 'index',
+                  model_aliases=None) -> pd.DataFrame:
     """
     获取、解析并处理聊天数据，返回一个包含问答对的DataFrame。
 
     Args:
         db_path (str): 数据库文件的路径。
+        incremental (bool): 是否启用增量抽取。启用后只读取上次运行以来 updated_at 有变化的会话，
+            并与 df_data/cache 中保存的已解析消息合并；首次运行或缓存失效时自动退化为全量抽取。
+            python 抽取方式下还会比较会话JSON的内容指纹，内容未变的会话不再重新解析。
+        cache_dir (str | Path, optional): 增量缓存目录，默认为 df_data/cache。
+        chunksize (int): 流式读取chat表时每块的会话数，决定了原始JSON的峰值内存占用。
+        extract_mode (str): 消息抽取方式。'python' 在Python中解析每个会话的JSON；
+            'sql' 使用SQLite的 json_each/json_extract 在数据库内展开 history.messages，两者结果相同。
+            例外：含 NaN/Infinity 的会话JSON只有 'python' 方式能解析，SQLite认为它不合法而跳过。
+        metrics_only (bool): 仅统计模式。不保留问题和回答的正文，只输出字符数和UTF-8字节数
+            （content_length/content_bytes、respond_content_length/respond_content_bytes），
+            足以生成汇总统计，内存占用和耗时都大幅降低。
+        workers (int): 解析进程数。大于1时按rowid区间切分chat表并在进程池中并行解析，
+            结果与串行解析完全一致。
+        timezone (str): 时间列（chat_created_at、chat_updated_at、created_at）换算成的时区。
+            解析和缓存中保留原始的Unix秒，返回前一次性换算为该时区的本地时间（不带时区信息）。
+        excluded_users (Iterable[str], optional): 不计入统计的用户名或用户ID，在SQL中直接过滤，
+            这些用户的会话不会被读出和解析。默认为 db_utils.DEFAULT_EXCLUDED_USERS。
+        branch_mode (str): 消息范围。'all' 保留重新生成和编辑产生的所有分支，每个问题取最新的回答；
+            'active' 只保留从 history.currentId 沿 parentId 回溯得到的当前分支，即用户在界面上看到的对话，
+            重新生成较多时可以少解析大量随后会被丢弃的消息。没有有效 currentId 的会话在该模式下不输出消息。
+        pairing (str): 问答配对方式。'index' 在解析时按 parentId 建立最新回答的索引，直接输出问答对，
+            不再持有回答的消息行，也不需要排序和合并；'pandas' 使用 _create_chat_view 配对，作为参考实现。
+            两者结果相同（索引配对只在同一会话内查找回答）。
+        model_aliases (ModelAliasTable, optional): 模型别名表和排除列表，在加载时对 last_chat_model、model、
+            answer_model 的类别以及 answer_calls 中的模型统一名称，再去掉 last_chat_model 属于排除列表的会话，
+            并去掉其余会话中由排除列表中的模型作答的回答（见 _exclude_answer_models）。缓存中保留原始名称，修改别名表不需要重建缓存。
+            默认为 model_aliases.DEFAULT_MODEL_ALIAS_TABLE，与 get_feedback_data 一致。
 
     Returns:
-        pd.DataFrame: 处理后的聊天数据。
+        pd.DataFrame: 处理后的聊天数据。chat_id、chat_user_id、user_name、role、model、last_chat_model、
+            answer_model、answer_status、answer_calls 为 category 类型，按这些列分组时应传入 observed=True。
     """
+    if excluded_users is None:
+        excluded_users = DEFAULT_EXCLUDED_USERS
+    if model_aliases is None:
+        model_aliases = DEFAULT_MODEL_ALIAS_TABLE
     try:
-        engine = get_db_engine(db_path)
-        raw_df = _fetch_raw_chat_data(engine)
-        parsed_df = _parse_chat_messages(raw_df)
-        chat_view_df = _create_chat_view(parsed_df)
-        return chat_view_df
+        parsed_df = _load_parsed_messages(db_path, incremental, cache_dir, chunksize, extract_mode, metrics_only,
+                                          workers, excluded_users, branch_mode, pairing)
+        parsed_df = convert_epoch_columns(parsed_df, CHAT_TIMESTAMP_COLUMNS, timezone)
+        parsed_df = categorize_columns(parsed_df, CHAT_CATEGORY_COLUMNS)
+        parsed_df = apply_model_alias_table(parsed_df, model_aliases, CHAT_MODEL_COLUMNS, 'last_chat_model')
+        if 'answer_calls' in parsed_df.columns:
+            parsed_df['answer_calls'] = _recode_answer_calls(parsed_df['answer_calls'], model_aliases.aliases)
+        if pairing != 'index':
+            parsed_df = _create_chat_view(parsed_df, latest_answer_only=branch_mode != 'active')
+        return _exclude_answer_models(parsed_df, model_aliases.excluded)
     except Exception as e:
         logger.error(f"获取聊天数据时出错: {e}")
         # 在高级别函数中捕获异常，可以返回一个空的DataFrame或重新引发异常
         # 这里选择返回空DataFrame，使调用方代码更健壮
         return pd.DataFrame()
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    # 用于对比不同抽取方式的耗时
+    parser = argparse.ArgumentParser(description='获取和处理聊天数据')
+    parser.add_argument('--db_path', type=str, required=True, help='数据库路径')
+    parser.add_argument('--extract_mode', type=str, default='python', choices=EXTRACT_MODES, help='消息抽取方式')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='流式读取时每块的行数')
+    parser.add_argument('--metrics_only', action='store_true', help='仅统计模式，不保留消息正文')
+    parser.add_argument('--workers', type=int, default=1, help='解析进程数')
+    parser.add_argument('--timezone', type=str, default=DEFAULT_TIMEZONE, help='时间戳换算成的时区')
+    parser.add_argument('--branch_mode', type=str, default='all', choices=BRANCH_MODES, help='消息范围')
+    parser.add_argument('--pairing', type=str, default='index', choices=PAIRING_MODES, help='问答配对方式')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    df = get_chat_data(args.db_path, chunksize=args.chunksize, extract_mode=args.extract_mode,
+                       metrics_only=args.metrics_only, workers=args.workers, timezone=args.timezone,
+                       branch_mode=args.branch_mode, pairing=args.pairing)
+    elapsed = time.perf_counter() - start
+    print(f"抽取方式: {args.extract_mode}，问答对: {len(df)} 行，耗时: {elapsed:.2f} 秒")
@@ -1,7 +1,10 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 import pandas as pd
 import logging
 from pathlib import Path
+import os
+import sqlite3
+import tempfile
 
 # 配置日志
 logging.basicConfig(
@@ -10,12 +13,67 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def get_db_engine(db_path: str):
+# 流式读取时每块的默认行数。chat/feedback 表的每一行都带有完整的会话JSON，块不宜过大
+DEFAULT_CHUNKSIZE = 500
+
+# 只读连接遇到写锁时的等待时间（毫秒）
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+
+# 每个新连接上执行的读取调优PRAGMA：大范围扫描 chat 表时使用内存映射I/O和更大的页缓存，
+# 排序/临时表放在内存中。可以在 get_db_engine 中通过 pragmas 参数覆盖
+DEFAULT_READ_PRAGMAS = {
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # 负数表示以KiB为单位，即64MB
+    'temp_store': 'MEMORY',
+}
+
+# 进程级的引擎注册表，同一数据库文件、相同参数的所有加载器共享一个引擎和连接池
+_ENGINES = {}
+
+# 在线备份每一步复制的页数和步间休眠时间（秒），步子越小对线上写入的影响越小
+DEFAULT_BACKUP_PAGES = 256
+DEFAULT_BACKUP_SLEEP = 0.005
+
+# 不计入统计的用户。每一项既按用户名也按用户ID匹配，聊天和反馈数据共用这一份配置
+DEFAULT_EXCLUDED_USERS = ('dali', 'cz', ' cz')
+
+def _connect_read_only(db_path: str, busy_timeout_ms: int) -> sqlite3.Connection:
+    """
+    以只读方式打开SQLite连接：URI mode=ro 保证不会写入文件，query_only 拒绝任何写语句，
+    busy_timeout 让读取在遇到写锁时短暂等待而不是立即失败。
     """
-    创建并返回一个SQLAlchemy引擎。
+    uri = f"{Path(db_path).resolve().as_uri()}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=busy_timeout_ms / 1000, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)}")
+    return conn
+
+def _apply_pragmas(engine, pragmas: dict):
+    """
+    注册连接事件，在连接池每次新建连接时执行给定的PRAGMA。
+    """
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+def get_db_engine(db_path: str, read_only: bool = False, busy_timeout_ms: int = DEFAULT_BUSY_TIMEOUT_MS,
+                  pragmas: dict = None):
+    """
+    返回一个SQLAlchemy引擎。引擎按数据库路径和参数缓存在进程内，
+    重复调用（例如聊天和反馈加载器）会复用同一个引擎和连接池。
 
     Args:
         db_path (str): SQLite数据库文件的路径。
+        read_only (bool): 是否以只读方式打开数据库。读取 Open WebUI 正在使用的 webui.db 时应开启，
+            避免抽取任务占用写锁、拖慢线上的聊天写入。
+        busy_timeout_ms (int): 只读模式下遇到写锁时的等待时间（毫秒）。
+        pragmas (dict, optional): 每个新连接上执行的PRAGMA，默认为 DEFAULT_READ_PRAGMAS，传入空字典则不设置。
 
     Returns:
         sqlalchemy.engine.Engine: 数据库引擎。
@@ -23,23 +81,106 @@ def get_db_engine(db_path: str):
     Raises:
         Exception: 如果创建引擎失败。
     """
+    if pragmas is None:
+        pragmas = DEFAULT_READ_PRAGMAS
     try:
         if not Path(db_path).exists():
             raise FileNotFoundError(f"数据库文件不存在: {db_path}")
-        engine = create_engine(f'sqlite:///{db_path}')
-        logger.info("数据库引擎创建成功。")
+        key = (str(Path(db_path).resolve()), read_only, busy_timeout_ms, tuple(sorted(pragmas.items())))
+        if key in _ENGINES:
+            return _ENGINES[key]
+        if read_only:
+            engine = create_engine('sqlite://', creator=lambda: _connect_read_only(db_path, busy_timeout_ms))
+        else:
+            engine = create_engine(f'sqlite:///{db_path}')
+        _apply_pragmas(engine, pragmas)
+        _ENGINES[key] = engine
+        logger.info(f"数据库引擎创建成功{'（只读）' if read_only else ''}。")
         return engine
     except Exception as e:
         logger.error(f"为 {db_path} 创建数据库引擎失败: {e}")
         raise
 
-def query_db(query: str, engine) -> pd.DataFrame:
+def dispose_engines():
+    """
+    关闭注册表中所有引擎的连接池并清空注册表。删除快照文件前需要先调用，
+    否则在Windows上文件仍被连接占用。
+    """
+    for engine in _ENGINES.values():
+        engine.dispose()
+    _ENGINES.clear()
+
+def reset_engines_after_fork():
+    """
+    在fork出的子进程中丢弃从父进程继承的引擎。SQLite连接不能跨进程共享，
+    dispose(close=False) 只丢弃连接池而不关闭父进程仍在使用的连接，之后子进程按需创建自己的引擎。
+    作为进程池的 initializer 使用。
+    """
+    for engine in _ENGINES.values():
+        engine.dispose(close=False)
+    _ENGINES.clear()
+
+def create_db_snapshot(db_path: str, snapshot_path: str = None,
+                       pages: int = DEFAULT_BACKUP_PAGES, sleep: float = DEFAULT_BACKUP_SLEEP,
+                       busy_timeout_ms: int = DEFAULT_BUSY_TIMEOUT_MS) -> str:
+    """
+    使用SQLite在线备份API为数据库创建一致性快照。
+
+    备份按 pages 页一步、步间休眠 sleep 秒进行，每一步只短暂持有读锁，对线上写入影响很小。
+    之后的所有查询都针对快照执行，chat 和 feedback 看到的是同一时间点的数据。
+    注意：备份期间如果源库被其它连接写入，SQLite 会从头重新开始备份，
+    写入非常频繁时可以适当调大 pages。
+
+    Args:
+        db_path (str): 源数据库文件的路径。
+        snapshot_path (str, optional): 快照文件路径，默认在系统临时目录中创建。
+        pages (int): 每一步复制的页数，-1 表示一次性复制全部。
+        sleep (float): 每一步之间的休眠时间（秒）。
+        busy_timeout_ms (int): 读取源库时遇到写锁的等待时间（毫秒）。
+
+    Returns:
+        str: 快照文件的路径，使用完毕后由调用方删除。
+
+    Raises:
+        Exception: 如果创建快照失败，此时自动创建的临时快照文件会被删除。
+    """
+    temporary = snapshot_path is None
+    if temporary:
+        fd, snapshot_path = tempfile.mkstemp(prefix="webui_snapshot_", suffix=".db")
+        os.close(fd)
+    src = None
+    dst = None
+    try:
+        if not Path(db_path).exists():
+            raise FileNotFoundError(f"数据库文件不存在: {db_path}")
+        src = _connect_read_only(db_path, busy_timeout_ms)
+        dst = sqlite3.connect(snapshot_path)
+        src.backup(dst, pages=pages, sleep=sleep)
+        logger.info(f"数据库快照创建成功: {snapshot_path}")
+        return str(snapshot_path)
+    except Exception as e:
+        logger.error(f"为 {db_path} 创建数据库快照失败: {e}")
+        if temporary:
+            # 先关闭连接再删除，Windows上文件被占用时无法删除
+            if dst is not None:
+                dst.close()
+                dst = None
+            Path(snapshot_path).unlink(missing_ok=True)
+        raise
+    finally:
+        if dst is not None:
+            dst.close()
+        if src is not None:
+            src.close()
+
+def query_db(query: str, engine, params: dict = None) -> pd.DataFrame:
     """
     执行SQL查询并以pandas DataFrame的形式返回结果。
 
     Args:
         query (str): 要执行的SQL查询。
         engine: 要使用的SQLAlchemy引擎。
+        params (dict, optional): SQL中命名参数（如 :since）的取值。
 
     Returns:
         pd.DataFrame: 包含查询结果的DataFrame。
@@ -48,9 +189,61 @@ def query_db(query: str, engine) -> pd.DataFrame:
         Exception: 如果查询执行失败。
     """
     try:
-        df = pd.read_sql_query(sql=text(query), con=engine)
+        df = pd.read_sql_query(sql=text(query), con=engine, params=params)
         logger.info(f"查询成功执行，返回 {len(df)} 行。")
         return df
     except Exception as e:
         logger.error(f"查询执行失败: {e}")
         raise
+
+def query_db_chunks(query: str, engine, chunksize: int = DEFAULT_CHUNKSIZE, params: dict = None):
+    """
+    以流式方式执行SQL查询，按固定行数逐块返回结果，峰值内存只与块大小有关，而与表大小无关。
+
+    Args:
+        query (str): 要执行的SQL查询。
+        engine: 要使用的SQLAlchemy引擎。
+        chunksize (int): 每块的行数。
+        params (dict, optional): SQL中命名参数（如 :since）的取值。
+
+    Yields:
+        pd.DataFrame: 每块最多包含 chunksize 行的DataFrame。
+
+    Raises:
+        Exception: 如果查询执行失败。
+    """
+    total = 0
+    try:
+        with engine.connect() as conn:
+            # stream_results 让驱动按需从游标取数，而不是一次性取回全部结果
+            conn = conn.execution_options(stream_results=True)
+            for chunk in pd.read_sql_query(sql=text(query), con=conn, params=params, chunksize=chunksize):
+                total += len(chunk)
+                yield chunk
+        logger.info(f"查询成功执行，分块返回 {total} 行。")
+    except Exception as e:
+        logger.error(f"查询执行失败: {e}")
+        raise
+
+def excluded_users_clause(excluded_users, user_id_column: str = 'user_id', param_prefix: str = 'excluded'):
+    """
+    构造排除指定用户的SQL条件，用于读取chat/feedback表时直接在数据库中过滤，
+    被排除用户的数据不会被读出和解析。
+
+    Args:
+        excluded_users (Iterable[str]): 要排除的用户名或用户ID。
+        user_id_column (str): 待过滤表中的用户ID列，例如 'user_id' 或 'a.user_id'。
+        param_prefix (str): SQL命名参数的前缀，避免与查询中的其它参数重名。
+
+    Returns:
+        tuple: (SQL条件, SQL参数)。没有要排除的用户时条件恒为真。
+            用户ID为空的记录无法对应到用户，予以保留。
+    """
+    excluded_users = sorted(set(excluded_users or ()))
+    if not excluded_users:
+        return "1 = 1", {}
+    params = {f"{param_prefix}_{i}": value for i, value in enumerate(excluded_users)}
+    placeholders = ", ".join(f":{key}" for key in params)
+    clause = (f"({user_id_column} IS NULL OR ({user_id_column} NOT IN ({placeholders})"
+              f" AND {user_id_column} NOT IN (SELECT id FROM user WHERE name IN ({placeholders}))))")
+    return clause, params
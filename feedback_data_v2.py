@@ -3,45 +3,165 @@ import pandas as pd
 import logging
 from pathlib import Path
 import json
-import datetime
 import argparse
 
-from db_utils import get_db_engine, query_db
+from db_utils import get_db_engine, query_db, query_db_chunks, DEFAULT_CHUNKSIZE, DEFAULT_EXCLUDED_USERS, \
+    excluded_users_clause
+from cache_utils import load_cache, save_cache
+import json_codec
+from parse_report import ParseReport
+from frame_utils import ColumnBuilder, DEFAULT_TIMEZONE, categorize_columns, convert_epoch_columns
+from model_aliases import DEFAULT_MODEL_ALIAS_TABLE, apply_model_alias_table
 
 # 只获取logger实例，不进行配置
 logger = logging.getLogger(__name__)
 
-def _fetch_raw_feedback_data(engine) -> pd.DataFrame:
+# 快照抽取方式：python 解码完整的会话快照；sql 只在SQLite中按 message_id 取出被评价的回答及其问题
+EXTRACT_MODES = ('python', 'sql')
+
+# 增量缓存的名称和格式版本，解析结果的列结构变化时需要递增版本
+FEEDBACK_CACHE_NAME = "feedback_entries"
+FEEDBACK_CACHE_VERSION = 3
+
+def _fetch_raw_feedback_data(engine, since=None, chunksize: int = DEFAULT_CHUNKSIZE,
+                             extract_mode: str = 'python', excluded_users=DEFAULT_EXCLUDED_USERS):
     """
-    从数据库获取原始反馈数据。
+    从数据库分块获取原始反馈数据。
+
+    Args:
+        engine: SQLAlchemy引擎。
+        since (int, optional): 增量水位线，只读取 updated_at 不早于该值的反馈；为 None 时读取全部。
+        chunksize (int): 每块的反馈条数。
+        extract_mode (str): 'python' 返回完整的 snapshot；'sql' 不返回 snapshot，
+            而是用 json_extract 按 meta.message_id 计算路径，只取出被评价的回答及其父消息（问题）。
+        excluded_users (Iterable[str]): 不读取这些用户（用户名或用户ID）的反馈，与聊天数据使用同一份配置。
+
+    Yields:
+        pd.DataFrame: 原始feedback记录块。
     """
-    query = """
-        SELECT a.*, b.name
-        FROM feedback a
-        LEFT JOIN user b ON a.user_id = b.id;
+    excluded, params = excluded_users_clause(excluded_users, 'a.user_id')
+    where = f"WHERE {excluded}"
+    if since is not None:
+        # 新建和修改的反馈都会刷新 updated_at
+        where += " AND a.updated_at >= :since"
+        params['since'] = since
+    if extract_mode == 'sql':
+        # 快照或meta不是合法JSON时 json_extract 会直接报错，因此先用 json_valid 判断。
+        # 每次 json_valid/json_extract/json_type 都会重新解析整个快照（SQLite 3.45 之前没有JSON解析缓存），
+        # 因此 json_valid 和被评价回答的提取各放在一个 MATERIALIZED CTE 中只计算一次，其余列由它们的结果得到：
+        # 回答能按 messages."ID" 取出时消息历史必然是对象，只有取不出时才需要 json_type 区分跳过原因。
+        # CTE 中只保存rowid和较小的列，快照本身不复制到临时表，需要时按rowid回表读取
+        query = f"""
+            WITH s AS MATERIALIZED (
+                SELECT
+                    a.rowid AS feedback_rowid,
+                    json_valid(a.snapshot) AS snapshot_valid,
+                    CASE WHEN json_valid(a.meta) THEN json_extract(a.meta, '$.message_id') END AS target_id
+                FROM feedback a
+                {where}
+            ),
+            f AS MATERIALIZED (
+                SELECT
+                    s.*,
+                    CASE WHEN s.snapshot_valid AND s.target_id IS NOT NULL
+                        THEN json_extract(a.snapshot, '$.chat.chat.history.messages."' || s.target_id || '"')
+                    END AS answer_json
+                FROM s
+                JOIN feedback a ON a.rowid = s.feedback_rowid
+            )
+            SELECT
+                a.id, a.user_id, a.created_at, a.updated_at, a.data, a.meta, b.name,
+                f.snapshot_valid,
+                CASE
+                    WHEN f.answer_json IS NOT NULL THEN 1
+                    WHEN f.snapshot_valid THEN json_type(a.snapshot, '$.chat.chat.history.messages') IS 'object'
+                END AS has_history,
+                f.answer_json,
+                CASE WHEN json_extract(f.answer_json, '$.parentId') IS NOT NULL
+                    THEN json_extract(a.snapshot, '$.chat.chat.history.messages."'
+                                      || json_extract(f.answer_json, '$.parentId') || '"')
+                END AS query_json
+            FROM f
+            JOIN feedback a ON a.rowid = f.feedback_rowid
+            LEFT JOIN user b ON a.user_id = b.id;
+        """
+    else:
+        query = f"""
+            SELECT a.*, b.name
+            FROM feedback a
+            LEFT JOIN user b ON a.user_id = b.id
+            {where};
+        """
+    return query_db_chunks(query, engine, chunksize=chunksize, params=params)
+
+def _targeted_history(r, message_id) -> dict:
+    """
+    由SQL取出的回答和问题构造一个只包含这两条消息的 history，
+    使后续逻辑与解码完整快照时一致。
     """
-    df = query_db(query, engine)
-    logger.info(f"成功读取feedback表数据，共 {len(df)} 条记录")
-    df.to_excel("debug_feedback_data_v2.xlsx", index=False)
-    return df
+    history_messages = {}
+    if r['answer_json'] is not None and not pd.isna(r['answer_json']):
+        answer_info = json_codec.decode_message(r['answer_json'])
+        history_messages[message_id] = answer_info
+        parentId = answer_info.get('parentId') if isinstance(answer_info, dict) else None
+        if parentId and r['query_json'] is not None and not pd.isna(r['query_json']):
+            history_messages[parentId] = json_codec.decode_message(r['query_json'])
+    return history_messages
+
+# 解析结果的列及其存储类型，见 frame_utils.ColumnBuilder。
+# created_at（被评价回答的时间）和 feedback_updated_at（反馈本身的更新时间）在解析和缓存中保留为Unix秒，返回前统一换算
+FEEDBACK_ENTRY_COLUMNS = {
+    "feedback_id": 'str',
+    "user_id": 'str',
+    "user_name": 'str',
+    "good_or_bad": 'str',
+    "rating_score": 'object',
+    "rating_comment": 'object',
+    "query": 'object',
+    "answer": 'object',
+    "model": 'str',
+    "message_id": 'object',
+    "parentId": 'object',
+    "created_at": 'float',
+    "feedback_updated_at": 'float',
+}
+FEEDBACK_TIMESTAMP_COLUMNS = ['created_at', 'feedback_updated_at']
+# 返回前转换为 category 类型的低基数列
+FEEDBACK_CATEGORY_COLUMNS = ['user_id', 'user_name', 'model']
 
-def _parse_feedback_entries(feedback_df: pd.DataFrame) -> pd.DataFrame:
+# 解析时跳过反馈的原因，计入 ParseReport
+SKIP_BAD_JSON = 'bad_json'  # 快照、data 或 meta 不是合法的JSON
+SKIP_MISSING_FIELD = 'missing_field'  # 原始记录缺少必要的列
+SKIP_BAD_STRUCTURE = 'bad_structure'  # JSON合法但结构不符，例如 meta 为 null、data 为数组
+SKIP_FILTERED_RATING = 'filtered_rating'  # 既不是好评/差评也不是改进建议
+SKIP_MISSING_MESSAGE_ID = 'missing_message_id'  # meta 中没有 message_id
+SKIP_MISSING_HISTORY = 'missing_history'  # 快照中没有消息历史
+SKIP_MESSAGE_NOT_IN_HISTORY = 'message_not_in_history'  # 被评价的消息不在快照的消息历史中
+
+def _parse_feedback_entries(feedback_df: pd.DataFrame, extract_mode: str = 'python',
+                            report: ParseReport = None) -> pd.DataFrame:
     """
     解析原始反馈DataFrame，提取有用的字段。
-    """
-    feedback_data = []
 
-    def timestamp_to_datetime(timestamp):
-        if timestamp is None:
-            return None
-        return datetime.datetime.fromtimestamp(timestamp)
+    Args:
+        feedback_df (pd.DataFrame): _fetch_raw_feedback_data 返回的原始反馈块。
+        extract_mode (str): 与读取时使用的抽取方式一致。
+        report (ParseReport, optional): 按原因记录被跳过的反馈，不逐条写日志。
+    """
+    if report is None:
+        report = ParseReport('feedback')
+    builder = ColumnBuilder(FEEDBACK_ENTRY_COLUMNS)
 
     for _, r in feedback_df.iterrows():
         feedback_id = r['id']
         try:
-            snapshot = json.loads(r['snapshot'])
-            data = json.loads(r['data'])
-            meta = json.loads(r['meta'])
+            if extract_mode == 'sql':
+                if not r['snapshot_valid']:
+                    raise json.JSONDecodeError("snapshot 不是合法的JSON", str(r['id']), 0)
+            else:
+                snapshot = json_codec.decode_feedback_snapshot(r['snapshot'])
+            data = json_codec.loads(r['data'])
+            meta = json_codec.loads(r['meta'])
             
             rating = data.get("rating")
             feedbackStatus = data.get("feedbackStatus",[])
@@ -60,64 +180,214 @@ def _parse_feedback_entries(feedback_df: pd.DataFrame) -> pd.DataFrame:
                 rating_str = "improve"
                 comment = improveText
             else:
+                report.add(SKIP_FILTERED_RATING, feedback_id)
                 continue
                 rating_str = "baddata"
 
             name = r.get('name')
-            if name in ['cz', ' cz']:
-                continue
 
             message_id = meta.get("message_id")
-            history_messages = snapshot.get('chat', {}).get('chat', {}).get('history', {}).get('messages', {})
+            if extract_mode == 'sql':
+                history_messages = _targeted_history(r, message_id)
+                has_history = bool(r['has_history'])
+            else:
+                history_messages = snapshot.get('chat', {}).get('chat', {}).get('history', {}).get('messages', {})
+                has_history = bool(history_messages)
             
-            if not all([message_id, history_messages]):
-                logger.warning(f"跳过 feedback_id: {feedback_id}，缺少 message_id 或 history_messages。")
+            if not message_id:
+                report.add(SKIP_MISSING_MESSAGE_ID, feedback_id)
+                continue
+            if not has_history:
+                report.add(SKIP_MISSING_HISTORY, feedback_id)
                 continue
 
             answer_info = history_messages.get(message_id)
             if not answer_info:
-                logger.warning(f"跳过 feedback_id: {feedback_id}，在 history 中找不到 message_id: {message_id}。")
+                report.add(SKIP_MESSAGE_NOT_IN_HISTORY, feedback_id, message_id)
                 continue
             
             parentId = answer_info.get('parentId')
             query_info = history_messages.get(parentId) if parentId else None
             
-            feedback_data.append({
-                "feedback_id": feedback_id,
-                "user_id": r['user_id'],
-                "user_name": name,
-                "good_or_bad": rating_str,
-                "rating_score": data.get("details", {}).get("rating", -99),
-                "rating_comment": data.get("comment", comment),
-                "query": query_info.get('content') if query_info else None,
-                "answer": answer_info.get('content'),
-                "model": answer_info.get('model'),
-                "message_id": message_id,
-                "parentId": parentId,
-                "created_at": timestamp_to_datetime(answer_info.get("timestamp")),
-            })
-
-        except (json.JSONDecodeError, KeyError) as e:
-            logger.error(f"解析 feedback_id: {feedback_id} 时出错: {e}", exc_info=True)
+            builder.add_row(
+                feedback_id,
+                r['user_id'],
+                name,
+                rating_str,
+                data.get("details", {}).get("rating", -99),
+                data.get("comment", comment),
+                query_info.get('content') if query_info else None,
+                answer_info.get('content'),
+                answer_info.get('model'),
+                message_id,
+                parentId,
+                answer_info.get("timestamp"),
+                r['updated_at'],
+            )
+
+        except json_codec.JSON_DECODE_ERRORS as e:
+            report.add(SKIP_BAD_JSON, feedback_id, e)
+            continue
+        except KeyError as e:
+            report.add(SKIP_MISSING_FIELD, feedback_id, e)
+            continue
+        except (AttributeError, TypeError) as e:
+            # 单条反馈的结构异常只跳过该条，不影响整批解析
+            report.add(SKIP_BAD_STRUCTURE, feedback_id, e)
+            continue
+
+    return builder.to_frame()
+
+def _parse_chunks(chunks, extract_mode: str = 'python', report: ParseReport = None):
+    """
+    逐块解析原始反馈。每块解析完后快照JSON即被释放，内存中只保留解析结果。
+    各块被跳过的反馈都计入同一个 report。
+
+    Returns:
+        tuple: (解析后的DataFrame, 本次读取到的反馈ID列表, 本次读取到的最大 updated_at)
+    """
+    parsed_chunks = []
+    fetched_ids = []
+    max_updated_at = None
+    for raw_chunk in chunks:
+        if raw_chunk.empty:
             continue
+        fetched_ids.extend(raw_chunk['id'])
+        chunk_max = int(raw_chunk['updated_at'].max())
+        max_updated_at = chunk_max if max_updated_at is None else max(max_updated_at, chunk_max)
+        parsed = _parse_feedback_entries(raw_chunk, extract_mode, report)
+        if not parsed.empty:
+            parsed_chunks.append(parsed)
+    logger.info(f"成功读取feedback表数据，共 {len(fetched_ids)} 条记录")
+    parsed_df = pd.concat(parsed_chunks, ignore_index=True) if parsed_chunks else pd.DataFrame()
+    return parsed_df, fetched_ids, max_updated_at
+
+def _mark_superseded(feedback_df: pd.DataFrame, message_ids=None) -> pd.DataFrame:
+    """
+    用户可能多次评价同一个回答。按 message_id 只保留最新的一条反馈（feedback_updated_at 最大，
+    相同时取 feedback_id 较大的一条），其余的 superseded 列标记为 True，原地修改并返回 feedback_df。
+
+    Args:
+        feedback_df (pd.DataFrame): 解析后的反馈。
+        message_ids (Iterable, optional): 只重新判断评价这些回答的反馈，其余行沿用已有的标记；
+            为 None 或还没有 superseded 列时判断全部反馈。
+    """
+    if feedback_df.empty:
+        return feedback_df
+    if message_ids is None or 'superseded' not in feedback_df.columns:
+        rows = feedback_df
+    else:
+        rows = feedback_df[feedback_df['message_id'].isin(message_ids)]
+    ordered = rows[['message_id', 'feedback_updated_at', 'feedback_id']].sort_values(
+        ['feedback_updated_at', 'feedback_id'], na_position='first')
+    superseded = ordered['message_id'].duplicated(keep='last')
+    if 'superseded' not in feedback_df.columns:
+        feedback_df['superseded'] = False
+    feedback_df.loc[superseded.index, 'superseded'] = superseded
+    feedback_df['superseded'] = feedback_df['superseded'].astype(bool)
+    return feedback_df
 
-    return pd.DataFrame(feedback_data)
+def _upsert_feedback(cached_df: pd.DataFrame, parsed_df: pd.DataFrame,
+                     fetched_ids, live_ids) -> pd.DataFrame:
+    """
+    按 feedback_id 将本次解析的反馈更新进缓存：本次读取到的反馈覆盖缓存中的旧记录
+    （修改后不再满足解析条件的反馈也会被移除），已从数据库删除的反馈从缓存中剔除。
+    只有新增、修改或删除的反馈所评价的回答需要重新确定最新的反馈，其余回答沿用缓存中的 superseded 标记。
+    """
+    if cached_df.empty:
+        return _mark_superseded(parsed_df)
+    keep = ~cached_df['feedback_id'].isin(fetched_ids) & cached_df['feedback_id'].isin(live_ids)
+    touched = set(cached_df.loc[~keep, 'message_id'])
+    if not parsed_df.empty:
+        touched.update(parsed_df['message_id'])
+    frames = [df for df in (cached_df[keep], parsed_df) if not df.empty]
+    if not frames:
+        return parsed_df
+    return _mark_superseded(pd.concat(frames, ignore_index=True), touched)
 
-def get_feedback_data(db_path: str) -> pd.DataFrame:
+def _load_parsed_feedback(engine, incremental: bool, cache_dir=None,
+                          chunksize: int = DEFAULT_CHUNKSIZE, extract_mode: str = 'python',
+                          excluded_users=DEFAULT_EXCLUDED_USERS, report: ParseReport = None) -> pd.DataFrame:
+    """
+    读取并解析反馈数据。增量模式下只解析水位线之后新建或修改的反馈，并按 feedback_id 更新缓存。
+    """
+    if extract_mode not in EXTRACT_MODES:
+        raise ValueError(f"不支持的抽取方式: {extract_mode}，可选: {EXTRACT_MODES}")
+    if not incremental:
+        parsed_df, _, _ = _parse_chunks(
+            _fetch_raw_feedback_data(engine, chunksize=chunksize, extract_mode=extract_mode,
+                                     excluded_users=excluded_users), extract_mode, report)
+        return _mark_superseded(parsed_df)
+
+    # 排除的用户变化后需要全量重建缓存
+    cache_params = {'excluded_users': sorted(set(excluded_users))}
+    watermark, cached_df = load_cache(FEEDBACK_CACHE_NAME, FEEDBACK_CACHE_VERSION, cache_dir, cache_params)
+    if cached_df is None:
+        watermark = None
+    parsed_df, fetched_ids, max_updated_at = _parse_chunks(
+        _fetch_raw_feedback_data(engine, since=watermark, chunksize=chunksize, extract_mode=extract_mode,
+                                 excluded_users=excluded_users),
+        extract_mode, report)
+
+    if cached_df is not None:
+        live_ids = query_db("SELECT id FROM feedback;", engine)['id']
+        parsed_df = _upsert_feedback(cached_df, parsed_df, fetched_ids, live_ids)
+        logger.info(f"增量解析 {len(fetched_ids)} 条反馈，合并后共 {len(parsed_df)} 条")
+    else:
+        parsed_df = _mark_superseded(parsed_df)
+
+    if max_updated_at is not None:
+        watermark = max_updated_at
+    save_cache(FEEDBACK_CACHE_NAME, FEEDBACK_CACHE_VERSION, watermark, parsed_df, cache_dir, cache_params)
+    return parsed_df
+
+def get_feedback_data(db_path: str, incremental: bool = False, cache_dir=None,
+                      chunksize: int = DEFAULT_CHUNKSIZE, extract_mode: str = 'python',
+                      timezone: str = DEFAULT_TIMEZONE, excluded_users=None, report: ParseReport = None,
+                      quarantine_dir=None, model_aliases=None) -> pd.DataFrame:
     """
     获取、解析并处理用户反馈数据。
 
     Args:
         db_path (str): 数据库文件的路径。
+        incremental (bool): 是否启用增量抽取。启用后只读取上次运行以来新建或修改的反馈，
+            并按 feedback_id 更新 df_data/cache 中保存的已解析反馈；首次运行或缓存失效时自动退化为全量抽取。
+        cache_dir (str | Path, optional): 增量缓存目录，默认为 df_data/cache。
+        chunksize (int): 流式读取feedback表时每块的反馈条数，决定了快照JSON的峰值内存占用。
+        extract_mode (str): 快照抽取方式。'python' 解码每条反馈的完整会话快照；
+            'sql' 只取出被评价的回答和它的问题，单条反馈的CPU和内存开销不再随会话长度增长。
+        timezone (str): created_at 换算成的时区，返回不带时区信息的本地时间。
+        excluded_users (Iterable[str], optional): 不计入统计的用户名或用户ID，在SQL中直接过滤。
+            默认为 db_utils.DEFAULT_EXCLUDED_USERS，与 get_chat_data 一致。
+        report (ParseReport, optional): 记录本次解析中被跳过的反馈（按原因计数并保留样本ID），
+            调用方可以在返回后读取计数写入运行报告。不传时在内部新建。
+        quarantine_dir (str | Path, optional): 隔离文件目录，默认为 df_data/quarantine。
+            被跳过反馈的计数和样本ID写入其中的 {日期}_feedback.json，日志中只输出一条汇总。
+        model_aliases (ModelAliasTable, optional): 模型别名表和排除列表，在加载时对 model 的类别统一名称，
+            再去掉被评价回答的模型属于排除列表的反馈。默认为 model_aliases.DEFAULT_MODEL_ALIAS_TABLE，与 get_chat_data 一致。
 
     Returns:
-        pd.DataFrame: 包含已解析反馈数据的DataFrame。
+        pd.DataFrame: 包含已解析反馈数据的DataFrame。user_id、user_name、model 为 category 类型。
+            同一回答被多次评价时只有最新的一条 superseded 为 False，统计时应只计入这些行。
     """
+    if excluded_users is None:
+        excluded_users = DEFAULT_EXCLUDED_USERS
+    if report is None:
+        report = ParseReport('feedback')
+    if model_aliases is None:
+        model_aliases = DEFAULT_MODEL_ALIAS_TABLE
     try:
-        engine = get_db_engine(db_path)
-        raw_df = _fetch_raw_feedback_data(engine)
-        parsed_df = _parse_feedback_entries(raw_df)
-        return parsed_df
+        engine = get_db_engine(db_path, read_only=True)
+        parsed_df = _load_parsed_feedback(engine, incremental, cache_dir, chunksize, extract_mode, excluded_users,
+                                          report)
+        report.log_summary()
+        quarantine_path = report.write_quarantine(quarantine_dir)
+        logger.info(f"被跳过反馈的样本已写入: {quarantine_path}")
+        if 'superseded' in parsed_df.columns:
+            logger.info(f"共 {len(parsed_df)} 条反馈，其中 {int(parsed_df['superseded'].sum())} 条被同一回答更新的评价取代")
+        parsed_df = convert_epoch_columns(parsed_df, FEEDBACK_TIMESTAMP_COLUMNS, timezone)
+        parsed_df = categorize_columns(parsed_df, FEEDBACK_CATEGORY_COLUMNS)
+        return apply_model_alias_table(parsed_df, model_aliases, ['model'], 'model')
     except Exception as e:
         logger.error(f"获取反馈数据时出错: {e}")
         return pd.DataFrame()
@@ -127,12 +397,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='获取和处理反馈数据')
     parser.add_argument('--db_path', type=str, default='/Users/lee/Documents/work/干预助手/dataset/webui.db', help='数据库路径')
     parser.add_argument('--output_path', type=str, default='debug_feedback_data_v2.xlsx', help='输出文件路径')
+    parser.add_argument('--extract_mode', type=str, default='python', choices=EXTRACT_MODES, help='快照抽取方式')
     args = parser.parse_args()
     
     logger.info(f"开始执行脚本，使用数据库路径: {args.db_path}")
     
     # 获取数据
-    df = get_feedback_data(args.db_path)
+    df = get_feedback_data(args.db_path, extract_mode=args.extract_mode)
     
     # 打印结果概览
     if not df.empty:
@@ -0,0 +1,158 @@
+import sys
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# 列的存储类型：
+#   'str'    低基数的字符串（ID、角色、模型名等），追加时驻留（intern），相同取值共用一个对象
+#   'int'    整数，存放在紧凑的 array('q') 中
+#   'float'  浮点数，存放在 array('d') 中，None 记为 NaN
+#   'object' 其它任意Python对象
+COLUMN_KINDS = ('str', 'int', 'float', 'object')
+
+# 解析时时间戳保留为Unix秒（float），最后统一换算为该时区的本地时间
+DEFAULT_TIMEZONE = 'Asia/Shanghai'
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class ColumnBuilder:
+    """
+    按列累积解析结果，最后一次性由各列构造DataFrame。
+
+    相比为每条消息创建一个字典再调用 pd.DataFrame(list_of_dicts)，
+    不需要为每一行保存重复的键，数值列直接存放在类型化数组中，构造DataFrame时也无需逐行推断列。
+    """
+
+    def __init__(self, columns: dict):
+        """
+        Args:
+            columns (dict): {列名: 存储类型}，顺序即为DataFrame的列顺序。
+        """
+        for name, kind in columns.items():
+            if kind not in COLUMN_KINDS:
+                raise ValueError(f"列 {name} 的存储类型 {kind} 不合法，可选: {COLUMN_KINDS}")
+        self._kinds = dict(columns)
+        self._data = {}
+        self._appenders = []
+        for name, kind in columns.items():
+            if kind == 'int':
+                store = array('q')
+            elif kind == 'float':
+                store = array('d')
+            else:
+                store = []
+            self._data[name] = store
+            if kind == 'str':
+                self._appenders.append(lambda value, append=store.append: append(_intern(value)))
+            elif kind == 'float':
+                self._appenders.append(lambda value, append=store.append: append(_to_float(value)))
+            else:
+                self._appenders.append(store.append)
+
+    def add_row(self, *values):
+        """
+        追加一行，values 按构造时的列顺序给出。
+        """
+        for append, value in zip(self._appenders, values):
+            append(value)
+
+    def __len__(self):
+        first = next(iter(self._data.values()), None)
+        return len(first) if first is not None else 0
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        由各列构造DataFrame。
+        """
+        columns = {}
+        for name, store in self._data.items():
+            kind = self._kinds[name]
+            if kind == 'int':
+                columns[name] = np.frombuffer(store, dtype=np.int64) if len(store) else np.empty(0, dtype=np.int64)
+            elif kind == 'float':
+                columns[name] = np.frombuffer(store, dtype=np.float64) if len(store) else np.empty(0)
+            else:
+                columns[name] = store
+        return pd.DataFrame(columns)
+
+
+def epoch_to_datetime(values, timezone: str = DEFAULT_TIMEZONE) -> pd.Series:
+    """
+    将Unix秒级时间戳一次性（向量化）换算为指定时区的本地时间。
+
+    结果为不带时区信息的 datetime64 列，可以直接按日期分组和导出Excel；
+    缺失或无法识别的值为 NaT。
+
+    Args:
+        values (pd.Series): Unix时间戳（秒）。
+        timezone (str): IANA时区名，例如 'Asia/Shanghai'、'UTC'。
+    """
+    seconds = pd.to_numeric(values, errors='coerce')
+    return pd.to_datetime(seconds, unit='s', utc=True, errors='coerce').dt.tz_convert(timezone).dt.tz_localize(None)
+
+
+def convert_epoch_columns(df: pd.DataFrame, columns, timezone: str = DEFAULT_TIMEZONE) -> pd.DataFrame:
+    """
+    将 df 中存在的时间戳列换算为本地时间，原地修改并返回 df。
+    """
+    for col in columns:
+        if col in df.columns:
+            df[col] = epoch_to_datetime(df[col], timezone)
+    return df
+
+
+def categorize_columns(df: pd.DataFrame, columns) -> pd.DataFrame:
+    """
+    将 df 中存在的低基数字符串列（用户、角色、模型等）转换为 category 类型，原地修改并返回 df。
+    每个取值只保存一份，各行只存整数编码，分组统计也直接在编码上进行。
+    分组时需传入 observed=True，否则会为未出现的类别组合生成空组。
+    """
+    for col in columns:
+        if col in df.columns:
+            # 先转为 object：全为空值的列在不同分块/并行方式下可能被推断为 float64 或 str，
+            # 统一后类别的类型只取决于实际取值
+            df[col] = df[col].astype(object).astype('category')
+    return df
+
+
+def recode_categories(series: pd.Series, mapping: dict) -> pd.Series:
+    """
+    按 mapping（{原类别: 新类别}）重命名 category 列的类别，多个类别映射到同一名称时合并为一个。
+    名称只在类别上处理（与类别数成正比），各行的整数编码通过一次数组索引换算，不逐行比较字符串。
+    对 category 列直接 replace 为不存在的类别会报错，因此需要通过该函数重命名。
+    """
+    categories = series.cat.categories
+    renamed = pd.Index([mapping.get(category, category) for category in categories])
+    if renamed.equals(categories):
+        return series
+    new_categories = renamed.unique()
+    # 末尾追加 -1，使缺失值的编码 -1 仍映射为 -1
+    code_map = np.append(new_categories.get_indexer(renamed), -1)
+    codes = code_map[series.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=new_categories), index=series.index,
+                     name=series.name)
+
+
+def drop_categories(df: pd.DataFrame, column: str, values) -> pd.DataFrame:
+    """
+    删除 category 列 column 的取值属于 values 的行，并从类别中去掉这些取值，返回新的DataFrame。
+    """
+    categories = df[column].cat.categories
+    excluded = [value for value in values if value in categories]
+    if not excluded:
+        return df
+    mask = np.isin(df[column].cat.codes.to_numpy(), categories.get_indexer(excluded))
+    df = df.loc[~mask].reset_index(drop=True)
+    df[column] = df[column].cat.remove_categories(excluded)
+    return df
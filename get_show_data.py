@@ -4,6 +4,7 @@
 # 3. 汇总数据：1）汇总所有数据的使用量和反馈量，不同模型的调用量和反馈量，汇总不同user使用量和反馈量，
 #          2）然后按天进行汇总使用量和反馈量，按天进行汇总不同user使用量和反馈量
 # 4. 保存数据为json格式
+import numpy as np
 import pandas as pd
 import json
 import datetime
@@ -11,8 +12,17 @@ import logging
 from pathlib import Path
 
 # 从重构后的模块中导入函数
-from chat_data import get_chat_data
-from feedback_data_v2 import get_feedback_data
+from chat_data import get_chat_data, answer_call_entries, EXTRACT_MODES, BRANCH_MODES, PAIRING_MODES, ANSWER_STATUSES
+from feedback_data_v2 import get_feedback_data, EXTRACT_MODES as FEEDBACK_EXTRACT_MODES
+from db_utils import DEFAULT_CHUNKSIZE, DEFAULT_EXCLUDED_USERS, create_db_snapshot, dispose_engines
+import json_codec
+from parse_report import ParseReport
+from frame_utils import DEFAULT_TIMEZONE
+from quantile_sketch import QuantileSketch
+from model_aliases import DEFAULT_MODEL_ALIAS_TABLE, load_model_alias_table
+
+# 回答耗时统计输出的分位点
+LATENCY_QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
 
 # 配置日志
 logging.basicConfig(
@@ -22,6 +32,316 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def _text_length(series: pd.Series) -> pd.Series:
+    """
+    计算文本列的字符数，缺失值（如没有回答的问题）和非字符串按0计。
+    """
+    return series.map(lambda value: len(value) if isinstance(value, str) else 0)
+
+def _latency_entry(sketch: QuantileSketch) -> dict:
+    """
+    由分位数草图生成一组回答耗时统计（秒）。草图本身也一并输出，之后可以直接合并为更粗粒度的分布。
+    """
+    entry = {'count': sketch.count}
+    for name, q in LATENCY_QUANTILES.items():
+        entry[name] = sketch.quantile(q)
+    entry['sketch'] = sketch.to_dict()
+    return entry
+
+def _latency_stats(chat_df: pd.DataFrame) -> dict:
+    """
+    按作答模型（answer_model）、按天以及按 (模型, 天) 统计回答耗时（response_latency）的分布，没有回答的问题不计入。
+    每个 (模型, 天) 只构造一次草图，按模型、按天和总体的分布都由这些草图合并得到，不再重新扫描数据；
+    by_model_day 中保存的草图可以跨天合并，得到任意日期范围内各模型的分布。
+    没有模型字段的回答只计入按天和总体的分布。
+    """
+    answered = chat_df.dropna(subset=['response_latency'])
+    days = answered['created_at'].dt.floor('D')
+
+    cell_sketches = {
+        (model, day.strftime('%Y-%m-%d')): QuantileSketch().add(group.to_numpy())
+        for (model, day), group in answered.groupby([answered['answer_model'], days], observed=True,
+                                                    dropna=False)['response_latency']
+        if not pd.isna(day)
+    }
+    overall = QuantileSketch()
+    by_model = {}
+    by_day = {}
+    by_model_day = {}
+    for (model, day), sketch in cell_sketches.items():
+        overall.merge(sketch)
+        by_day.setdefault(day, QuantileSketch()).merge(sketch)
+        if pd.isna(model):
+            continue
+        by_model.setdefault(model, QuantileSketch()).merge(sketch)
+        by_model_day.setdefault(model, {})[day] = sketch
+
+    return {
+        'overall': _latency_entry(overall),
+        'by_model': {model: _latency_entry(sketch) for model, sketch in by_model.items()},
+        'by_day': {day: _latency_entry(by_day[day]) for day in sorted(by_day)},
+        'by_model_day': {model: {day: _latency_entry(sketch) for day, sketch in daily.items()}
+                         for model, daily in by_model_day.items()},
+    }
+
+# 按维度汇总时的输出键和分组列，day 为按天取整的 created_at
+SUMMARY_DIMENSIONS = {'by_model': 'last_chat_model', 'by_user': 'user_name', 'by_day': 'day'}
+# 统计的是问答对中的回答本身（用量、状态等）时，按实际作答的模型分组
+ANSWER_SUMMARY_DIMENSIONS = {**SUMMARY_DIMENSIONS, 'by_model': 'answer_model'}
+
+def _optional_float(value):
+    """
+    NaN 转为 None，使结果可以写入JSON。
+    """
+    return None if pd.isna(value) else float(value)
+
+def _dimension_frame(chat_df: pd.DataFrame, **columns) -> pd.DataFrame:
+    """
+    构造按维度汇总用的DataFrame：各维度的分组列加上 columns 中给出的待聚合列。
+    """
+    return pd.DataFrame({
+        'last_chat_model': chat_df['last_chat_model'],
+        'answer_model': chat_df['answer_model'],
+        'user_name': chat_df['user_name'],
+        'day': chat_df['created_at'].dt.floor('D'),
+        **columns,
+    })
+
+def _grouped_stats(frame: pd.DataFrame, aggregations: dict, to_entry, dimensions=SUMMARY_DIMENSIONS) -> dict:
+    """
+    对总体和每个维度各做一次分组聚合。
+
+    Args:
+        frame (pd.DataFrame): _dimension_frame 的结果。
+        aggregations (dict): 传给 groupby().agg 的命名聚合。
+        to_entry: 把一组的聚合结果（pd.Series）转换为输出字典的函数。
+        dimensions (dict): {输出键: 分组列}。
+
+    Returns:
+        dict: {'overall': {...}, 输出键: {分组取值: {...}}}。
+    """
+    overall = frame.groupby(pd.Series('overall', index=frame.index)).agg(**aggregations)
+    stats = {'overall': to_entry(overall.iloc[0]) if not overall.empty else {}}
+    for name, column in dimensions.items():
+        grouped = frame.groupby(column, observed=True).agg(**aggregations)
+        if column == 'day':
+            grouped.index = grouped.index.strftime('%Y-%m-%d')
+        stats[name] = {key: to_entry(row) for key, row in grouped.iterrows()}
+    return stats
+
+def _usage_stats(chat_df: pd.DataFrame) -> dict:
+    """
+    按作答模型（answer_model）、用户和天汇总回答的token用量与生成吞吐，每个维度只做一次分组聚合。
+    只统计每个问题最终所配的回答：被重新生成替换掉的回答不计入，因此token总数低于实际消耗，
+    也与 regeneration_stats 的 inference_calls 不可比，字段名带 final_ 前缀以示区别。
+
+    - final_usage_count: 带有token用量的最终回答数
+    - final_prompt_tokens / final_completion_tokens: 最终回答的输入和输出token总数
+    - tokens_per_second: 输出token总数 / 生成耗时（eval_duration）总和，只计入两者都有的回答，
+      按token数加权，不受短回答的极端速度影响
+    - avg_generation_time: 每个请求的平均耗时（秒），优先使用 total_duration，没有时使用 eval_duration
+    """
+    timed = chat_df['completion_tokens'].notna() & (chat_df['eval_duration'] > 0)
+    usage = _dimension_frame(
+        chat_df,
+        has_usage=chat_df[['prompt_tokens', 'completion_tokens']].notna().any(axis=1),
+        prompt_tokens=chat_df['prompt_tokens'],
+        completion_tokens=chat_df['completion_tokens'],
+        timed_tokens=chat_df['completion_tokens'].where(timed),
+        timed_duration=chat_df['eval_duration'].where(timed),
+        generation_time=chat_df['total_duration'].fillna(chat_df['eval_duration']),
+    )
+    aggregations = dict(
+        usage_count=('has_usage', 'sum'),
+        prompt_tokens=('prompt_tokens', 'sum'),
+        completion_tokens=('completion_tokens', 'sum'),
+        timed_tokens=('timed_tokens', 'sum'),
+        timed_duration=('timed_duration', 'sum'),
+        avg_generation_time=('generation_time', 'mean'),
+    )
+
+    def to_entry(row: pd.Series) -> dict:
+        return {
+            'final_usage_count': int(row['usage_count']),
+            'final_prompt_tokens': int(row['prompt_tokens']),
+            'final_completion_tokens': int(row['completion_tokens']),
+            'tokens_per_second': float(row['timed_tokens'] / row['timed_duration']) if row['timed_duration'] > 0 else None,
+            'avg_generation_time': _optional_float(row['avg_generation_time']),
+        }
+
+    return _grouped_stats(usage, aggregations, to_entry, ANSWER_SUMMARY_DIMENSIONS)
+
+def _regeneration_stats(chat_df: pd.DataFrame) -> dict:
+    """
+    按模型、用户和天汇总重新生成情况，直接使用解析时统计的 answer_count/regenerated_count，不再遍历消息。
+    按模型统计时使用 answer_calls：同一问题由多个模型回答时，各模型的回答和重新生成分别计入实际作答的模型。
+
+    - answered_queries: 至少有一个回答的问题数
+    - regenerated_queries: 重新生成过的问题数
+    - regeneration_rate: regenerated_queries / answered_queries
+    - inference_calls: 回答总数，即推理调用次数
+    - extra_inference_calls: 重新生成带来的额外推理调用次数
+    """
+    regeneration = _dimension_frame(
+        chat_df,
+        answered=chat_df['answer_count'] > 0,
+        regenerated=chat_df['regenerated_count'] > 0,
+        answer_count=chat_df['answer_count'],
+        regenerated_count=chat_df['regenerated_count'],
+    )
+    aggregations = dict(
+        answered_queries=('answered', 'sum'),
+        regenerated_queries=('regenerated', 'sum'),
+        inference_calls=('answer_count', 'sum'),
+        extra_inference_calls=('regenerated_count', 'sum'),
+    )
+
+    def to_entry(row: pd.Series) -> dict:
+        answered = int(row['answered_queries'])
+        return {
+            'answered_queries': answered,
+            'regenerated_queries': int(row['regenerated_queries']),
+            'regeneration_rate': float(row['regenerated_queries'] / answered) if answered > 0 else 0,
+            'inference_calls': int(row['inference_calls']),
+            'extra_inference_calls': int(row['extra_inference_calls']),
+        }
+
+    dimensions = {name: column for name, column in SUMMARY_DIMENSIONS.items() if name != 'by_model'}
+    stats = _grouped_stats(regeneration, aggregations, to_entry, dimensions)
+    # 每个 (问题, 作答模型) 一行：该模型的回答数为 calls，其中计为重新生成的为 regenerated
+    calls = answer_call_entries(chat_df['answer_calls'])
+    by_model = pd.DataFrame({
+        'answer_model': calls['answer_model'],
+        'answered': True,
+        'regenerated': calls['regenerated'] > 0,
+        'answer_count': calls['calls'],
+        'regenerated_count': calls['regenerated'],
+    }).groupby('answer_model').agg(**aggregations)
+    return {
+        'overall': stats['overall'],
+        'by_model': {model: to_entry(row) for model, row in by_model.iterrows()},
+        **{name: stats[name] for name in dimensions},
+    }
+
+def _failure_stats(chat_df: pd.DataFrame) -> dict:
+    """
+    按模型和天汇总回答失败情况（状态见 chat_data.ANSWER_STATUSES）。
+
+    - inference_calls / failed_calls: 全部回答数及其中状态不是 ok 的回答数，包括被重新生成替换掉的回答
+    - failure_rate: failed_calls / inference_calls
+    - answer_status: 每个问题最终所配回答的状态计数
+    按模型统计时，回答数和失败数按 answer_calls 分别计入实际作答的各个模型，answer_status 计入所配回答的模型。
+    """
+    failures = _dimension_frame(
+        chat_df,
+        answer_count=chat_df['answer_count'],
+        failed_count=chat_df['failed_count'],
+        **{f'status_{status}': chat_df['answer_status'] == status for status in ANSWER_STATUSES},
+    )
+    aggregations = dict(
+        inference_calls=('answer_count', 'sum'),
+        failed_calls=('failed_count', 'sum'),
+        **{f'status_{status}': (f'status_{status}', 'sum') for status in ANSWER_STATUSES},
+    )
+
+    def to_entry(row: pd.Series) -> dict:
+        calls = int(row['inference_calls'])
+        return {
+            'inference_calls': calls,
+            'failed_calls': int(row['failed_calls']),
+            'failure_rate': float(row['failed_calls'] / calls) if calls > 0 else 0,
+            'answer_status': {status: int(row[f'status_{status}']) for status in ANSWER_STATUSES},
+        }
+
+    stats = _grouped_stats(failures, aggregations, to_entry, {'by_day': SUMMARY_DIMENSIONS['by_day']})
+    calls = answer_call_entries(chat_df['answer_calls'])
+    no_status = {f'status_{status}': 0 for status in ANSWER_STATUSES}
+    by_model = pd.concat([
+        pd.DataFrame({'answer_model': calls['answer_model'], 'answer_count': calls['calls'],
+                      'failed_count': calls['failed'], **no_status}),
+        failures[['answer_model', *no_status]].assign(answer_count=0, failed_count=0),
+    ], ignore_index=True).groupby('answer_model').agg(**aggregations)
+    return {
+        'overall': stats['overall'],
+        'by_model': {model: to_entry(row) for model, row in by_model.iterrows()},
+        'by_day': stats['by_day'],
+    }
+
+def _row_index(keys: pd.Series) -> pd.Series:
+    """
+    建立 键 -> 行位置 的哈希索引，忽略空值；重复的键（例如复制的会话）取第一次出现的行。
+    """
+    rows = pd.Series(np.arange(len(keys)), index=keys.to_numpy())
+    return rows[rows.index.notna() & ~rows.index.duplicated()]
+
+def _match_feedback(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) -> tuple:
+    """
+    找出每条反馈评价的问答对在 chat_df 中的行位置，找不到为 -1。
+
+    先按 message_id 匹配问答对的 answer_message_id（评价的正是问答对中的回答）；
+    没有匹配上的，再按反馈的 parentId 匹配问题的 message_id（评价的是该问题被重新生成替换掉的旧回答）。
+    两个索引各建立一次，每条反馈只做哈希查找。
+
+    Returns:
+        tuple: (行位置, 是否为按 parentId 匹配上的)，均为与 feedback_df 等长的数组。
+    """
+    positions = _row_index(chat_df['answer_message_id']).reindex(feedback_df['message_id'].to_numpy())
+    unmatched = positions.isna().to_numpy()
+    by_parent = np.zeros(len(feedback_df), dtype=bool)
+    if unmatched.any():
+        by_query = _row_index(chat_df['message_id']).reindex(feedback_df['parentId'].to_numpy()[unmatched])
+        positions.iloc[unmatched] = by_query.to_numpy()
+        by_parent[unmatched] = by_query.notna().to_numpy()
+    return positions.fillna(-1).astype('int64').to_numpy(), by_parent
+
+def _feedback_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) -> dict:
+    """
+    把每条反馈对应到它评价的问答对后，按问答对的作答模型（answer_model）、用户和问题日期汇总反馈率，
+    分子和分母来自同一张表，不会因为两侧的模型列或日期不同而错位。没有回答的问题没有作答模型，不计入按模型的统计。
+    按 parentId 匹配上的反馈评价的是被替换掉的旧回答，其模型可能不同于问答对的 answer_model，
+    因此只计入总体、按用户和按天的统计，不计入按模型的统计。
+
+    - usage_count: 问题数
+    - feedback_count / good / bad / improve: 对应到这些问题的反馈数及各评价的数量
+    - feedback_ratio / excellent_rate / error_rate / improve_rate: 以上数量 / usage_count
+    总体统计中另有 unmatched_feedbacks：在 chat_df 中找不到对应问答对的反馈数（例如会话已删除或被过滤）；
+    parent_matched_feedbacks：按 parentId 对应到问题的反馈数。
+    """
+    positions, by_parent = _match_feedback(chat_df, feedback_df)
+    matched = positions >= 0
+    ratings = feedback_df['good_or_bad'].to_numpy()
+
+    def feedback_frame(selected: np.ndarray) -> pd.DataFrame:
+        counts = {
+            'feedback_count': np.bincount(positions[selected], minlength=len(chat_df)),
+            **{rating: np.bincount(positions[selected & (ratings == rating)], minlength=len(chat_df))
+               for rating in ('good', 'bad', 'improve')},
+        }
+        return _dimension_frame(chat_df, **{name: pd.Series(count, index=chat_df.index)
+                                            for name, count in counts.items()})
+
+    count_names = ('feedback_count', 'good', 'bad', 'improve')
+    aggregations = dict(
+        usage_count=('feedback_count', 'size'),
+        **{name: (name, 'sum') for name in count_names},
+    )
+
+    def to_entry(row: pd.Series) -> dict:
+        usage = int(row['usage_count'])
+        entry = {name: int(row[name]) for name in ('usage_count', *count_names)}
+        for rate, name in (('feedback_ratio', 'feedback_count'), ('excellent_rate', 'good'),
+                           ('error_rate', 'bad'), ('improve_rate', 'improve')):
+            entry[rate] = float(row[name] / usage) if usage > 0 else 0
+        return entry
+
+    dimensions = {name: column for name, column in ANSWER_SUMMARY_DIMENSIONS.items() if name != 'by_model'}
+    stats = _grouped_stats(feedback_frame(matched), aggregations, to_entry, dimensions)
+    by_model = _grouped_stats(feedback_frame(matched & ~by_parent), aggregations, to_entry,
+                              {'by_model': ANSWER_SUMMARY_DIMENSIONS['by_model']})['by_model']
+    stats['overall']['unmatched_feedbacks'] = int((~matched).sum())
+    stats['overall']['parent_matched_feedbacks'] = int(by_parent.sum())
+    return {'overall': stats['overall'], 'by_model': by_model, **{name: stats[name] for name in dimensions}}
+
 def generate_summary_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) -> dict:
     """
     根据聊天和反馈数据生成汇总统计信息。
@@ -35,28 +355,28 @@ def generate_summary_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) ->
     """
     summary = {}
 
-    # 确保日期列是datetime类型，以便进行时间序列分析
-    chat_df['created_at'] = pd.to_datetime(chat_df['created_at'], errors='coerce')
-    feedback_df['created_at'] = pd.to_datetime(feedback_df['created_at'], errors='coerce')
+    # created_at 在 get_chat_data/get_feedback_data 中已统一换算为 datetime64，这里不再重复转换
 
     # 删除缺少关键信息的行
     chat_df.dropna(subset=['created_at', 'user_name', 'last_chat_model'], inplace=True)
     feedback_df.dropna(subset=['created_at', 'user_name', 'model'], inplace=True)
 
-    # 替换模型名称
-    chat_df['last_chat_model'] = chat_df['last_chat_model'].replace('星伴V1.1', '聆境 1.1').replace('聆镜 1.1',
-                                                                                                    '聆境 1.1')
-    feedback_df['model'] = feedback_df['model'].replace('星伴V1.1', '聆境 1.1').replace('聆镜 1.1', '聆境 1.1')
+    # 同一回答被多次评价时只统计最新的一条
+    if 'superseded' in feedback_df.columns:
+        feedback_df = feedback_df[~feedback_df['superseded']]
 
-    not_use_model_list = ["星伴V1.1", "星伴v1.2", "arena-model"]
-    chat_df = chat_df[~chat_df['last_chat_model'].isin(not_use_model_list)]
-    feedback_df = feedback_df[~feedback_df['model'].isin(not_use_model_list)]
+    # 模型名称的别名替换和排除已在 get_chat_data/get_feedback_data 加载时按模型别名表完成
 
     # 计算文字量统计（新增功能）
-    # 用户输入文字量（字符数）
-    chat_df['user_text_length'] = chat_df['content'].astype(str).str.len()
-    # AI输出文字量（字符数）
-    chat_df['ai_text_length'] = chat_df['respond_content'].astype(str).str.len()
+    if 'content_length' in chat_df.columns:
+        # 仅统计模式：解析时已经算好字符数，不再持有正文
+        chat_df['user_text_length'] = chat_df['content_length'].fillna(0)
+        chat_df['ai_text_length'] = chat_df['respond_content_length'].fillna(0)
+    else:
+        # 用户输入文字量（字符数）
+        chat_df['user_text_length'] = _text_length(chat_df['content'])
+        # AI输出文字量（字符数）
+        chat_df['ai_text_length'] = _text_length(chat_df['respond_content'])
 
     # 1. 总体统计（添加文字量统计）
     summary['overall_stats'] = {
@@ -67,12 +387,16 @@ def generate_summary_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) ->
         'total_user_text_length': int(chat_df['user_text_length'].sum()),
         'total_ai_text_length': int(chat_df['ai_text_length'].sum()),
     }
+    if 'content_bytes' in chat_df.columns:
+        summary['overall_stats']['total_user_text_bytes'] = int(chat_df['content_bytes'].fillna(0).sum())
+        summary['overall_stats']['total_ai_text_bytes'] = int(chat_df['respond_content_bytes'].fillna(0).sum())
 
     # 2. 按模型统计（添加文字量统计）
-    model_usage = chat_df['last_chat_model'].value_counts().to_dict()
-    model_feedback = feedback_df['model'].value_counts().to_dict()
-    model_user_text = chat_df.groupby('last_chat_model')['user_text_length'].sum().to_dict()
-    model_ai_text = chat_df.groupby('last_chat_model')['ai_text_length'].sum().to_dict()
+    # 模型、用户等列为 category 类型，分组时使用 observed=True，只统计实际出现的类别
+    model_usage = chat_df.groupby('last_chat_model', observed=True).size().to_dict()
+    model_feedback = feedback_df.groupby('model', observed=True).size().to_dict()
+    model_user_text = chat_df.groupby('last_chat_model', observed=True)['user_text_length'].sum().to_dict()
+    model_ai_text = chat_df.groupby('last_chat_model', observed=True)['ai_text_length'].sum().to_dict()
 
     model_stats = {
         model: {
@@ -85,10 +409,10 @@ def generate_summary_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) ->
     summary['model_stats'] = model_stats
 
     # 3. 按用户统计（添加文字量统计）
-    user_usage = chat_df['user_name'].value_counts().to_dict()
-    user_feedback = feedback_df['user_name'].value_counts().to_dict()
-    user_user_text = chat_df.groupby('user_name')['user_text_length'].sum().to_dict()
-    user_ai_text = chat_df.groupby('user_name')['ai_text_length'].sum().to_dict()
+    user_usage = chat_df.groupby('user_name', observed=True).size().to_dict()
+    user_feedback = feedback_df.groupby('user_name', observed=True).size().to_dict()
+    user_user_text = chat_df.groupby('user_name', observed=True)['user_text_length'].sum().to_dict()
+    user_ai_text = chat_df.groupby('user_name', observed=True)['ai_text_length'].sum().to_dict()
 
     user_stats = {
         user: {
@@ -116,7 +440,7 @@ def generate_summary_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) ->
     # 4.1. 按天统计好评和差评
     if not feedback_df.empty and 'good_or_bad' in feedback_df.columns:
         daily_feedback_by_rating = feedback_df.groupby(
-            [pd.Grouper(key='created_at', freq='D'), 'good_or_bad']).size().unstack(fill_value=0)
+            [pd.Grouper(key='created_at', freq='D'), 'good_or_bad'], observed=True).size().unstack(fill_value=0)
         # 确保'good'和'bad'列存在
         if 'good' not in daily_feedback_by_rating.columns:
             daily_feedback_by_rating['good'] = 0
@@ -151,13 +475,13 @@ def generate_summary_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) ->
     summary['daily_stats'] = daily_stats.to_dict('index')
 
     # 5. 按天和用户统计 (修改为列表形式，添加文字量统计)
-    daily_user_usage = chat_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name']).size().reset_index(
-        name='usage_count')
-    daily_user_feedback = feedback_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name']).size().reset_index(
-        name='feedback_count')
-    daily_user_text = chat_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name'])[
+    daily_user_usage = chat_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name'],
+                                       observed=True).size().reset_index(name='usage_count')
+    daily_user_feedback = feedback_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name'],
+                                              observed=True).size().reset_index(name='feedback_count')
+    daily_user_text = chat_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name'], observed=True)[
         'user_text_length'].sum().reset_index(name='user_text_length')
-    daily_ai_text = chat_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name'])[
+    daily_ai_text = chat_df.groupby([pd.Grouper(key='created_at', freq='D'), 'user_name'], observed=True)[
         'ai_text_length'].sum().reset_index(name='ai_text_length')
 
     # 将日期转换为字符串
@@ -198,6 +522,26 @@ def generate_summary_stats(chat_df: pd.DataFrame, feedback_df: pd.DataFrame) ->
     # 转换为字典列表
     summary['daily_user_stats'] = daily_user_stats_df.to_dict('records')
 
+    # 6. 回答耗时分布（秒），按模型和按天给出 p50/p90/p99
+    if 'response_latency' in chat_df.columns:
+        summary['latency_stats'] = _latency_stats(chat_df)
+
+    # 7. 最终回答的token用量和生成吞吐，按模型、用户和天汇总
+    if 'completion_tokens' in chat_df.columns:
+        summary['usage_stats'] = _usage_stats(chat_df)
+
+    # 8. 重新生成率和额外推理调用，按模型、用户和天汇总
+    if 'answer_count' in chat_df.columns:
+        summary['regeneration_stats'] = _regeneration_stats(chat_df)
+
+    # 9. 回答失败率（报错、中断、空回答），按模型和天汇总
+    if 'answer_status' in chat_df.columns:
+        summary['failure_stats'] = _failure_stats(chat_df)
+
+    # 10. 按问答对统计的反馈率：反馈按 message_id 对应到所评价的回答，分子分母来自同一张表
+    if 'answer_message_id' in chat_df.columns and not feedback_df.empty:
+        summary['feedback_stats'] = _feedback_stats(chat_df, feedback_df)
+
     return summary
 
 def default_json_serializer(obj):
@@ -219,6 +563,9 @@ def save_all_data(chat_df,feedback_df):
     feedback_df.to_csv(output_dir / f"{time_now}_feedback_data.csv",index=False,encoding="utf-8-sig")
     
     # 保存详细的反馈数据为JSON格式（用于dashboard查看）
+    # CSV 保留全部评价及 superseded 标记；明细页直接按条计数，只写入每个回答最新的一条评价
+    if 'superseded' in feedback_df.columns:
+        feedback_df = feedback_df[~feedback_df['superseded']]
     if not feedback_df.empty:
         # 准备用于前端展示的反馈明细数据
         feedback_detail_data = []
@@ -252,14 +599,62 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='获取和处理数据')
     parser.add_argument('--db_path', type=str, default='/root/autodl-tmp/dev/open_webui/backend/data/webui.db', help='数据库路径')
+    parser.add_argument('--incremental', action='store_true', help='增量抽取：只解析上次运行以来有更新的会话和反馈，并与 df_data/cache 中的缓存合并')
+    parser.add_argument('--cache_dir', type=str, default=None, help='增量缓存目录，默认为 df_data/cache')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='流式读取时每块的行数，决定原始JSON的峰值内存占用')
+    parser.add_argument('--snapshot', action='store_true', help='先用SQLite在线备份为数据库创建一致性快照，再从快照中读取聊天和反馈数据')
+    parser.add_argument('--chat_extract_mode', type=str, default='python', choices=EXTRACT_MODES, help='聊天消息抽取方式：python 在Python中解析会话JSON；sql 使用SQLite JSON1在数据库内展开消息')
+    parser.add_argument('--feedback_extract_mode', type=str, default='python', choices=FEEDBACK_EXTRACT_MODES, help='反馈快照抽取方式：python 解码完整快照；sql 只取出被评价的回答及其问题')
+    parser.add_argument('--metrics_only', action='store_true', help='仅统计模式：解析时只计算问题和回答的字符数/字节数，不保留正文')
+    parser.add_argument('--json_decoder', type=str, default='auto', choices=json_codec.DECODER_BACKENDS, help='JSON解码后端，auto 优先使用已安装的 msgspec/orjson')
+    parser.add_argument('--workers', type=int, default=1, help='聊天数据解析进程数，大于1时按rowid区间并行解析')
+    parser.add_argument('--exclude_users', type=str, nargs='*', default=None, help=f'不计入统计的用户名或用户ID，聊天和反馈数据共用，默认: {list(DEFAULT_EXCLUDED_USERS)}；只写该参数不跟值表示不排除任何用户')
+    parser.add_argument('--branch_mode', type=str, default='all', choices=BRANCH_MODES, help='聊天消息范围：all 保留所有重新生成/编辑分支，每个问题取最新回答；active 只保留 history.currentId 所在的当前分支')
+    parser.add_argument('--pairing', type=str, default='index', choices=PAIRING_MODES, help='问答配对方式：index 在解析时按 parentId 建立最新回答的索引直接输出问答对；pandas 为参考实现')
+    parser.add_argument('--timezone', type=str, default=DEFAULT_TIMEZONE, help='时间戳换算成的时区（IANA时区名），按天统计也以该时区的日期为准')
+    parser.add_argument('--model_aliases', type=str, default=None, help='模型别名表JSON文件，格式为 {"aliases": {原名称: 统一后的名称}, "excluded": [不计入统计的模型]}，先替换别名再排除；默认使用 model_aliases.py 中的配置')
     args = parser.parse_args()
+    try:
+        pd.Timestamp(0, tz=args.timezone)
+    except Exception:
+        parser.error(f"无法识别的时区: {args.timezone}")
+    model_aliases = DEFAULT_MODEL_ALIAS_TABLE
+    if args.model_aliases:
+        try:
+            model_aliases = load_model_alias_table(args.model_aliases)
+        except (OSError, ValueError) as e:
+            parser.error(f"无法读取模型别名表 {args.model_aliases}: {e}")
     db_path = args.db_path
     
     logger.info("开始获取和处理数据...")
-    
+    json_codec.set_decoder(args.json_decoder)
+
+    # 快照模式下，聊天和反馈都从同一个快照读取，看到的是同一时间点的数据
+    snapshot_path = None
+    if args.snapshot:
+        snapshot_path = create_db_snapshot(db_path)
+        db_path = snapshot_path
+
     # 1. 获取聊天和反馈数据
-    chat_df = get_chat_data(db_path)
-    feedback_df = get_feedback_data(db_path)
+    feedback_report = ParseReport('feedback')
+    try:
+        chat_df = get_chat_data(db_path, incremental=args.incremental, cache_dir=args.cache_dir,
+                                chunksize=args.chunksize, extract_mode=args.chat_extract_mode,
+                                metrics_only=args.metrics_only, workers=args.workers, timezone=args.timezone,
+                                excluded_users=args.exclude_users, branch_mode=args.branch_mode,
+                                pairing=args.pairing, model_aliases=model_aliases)
+        feedback_df = get_feedback_data(db_path, incremental=args.incremental, cache_dir=args.cache_dir,
+                                        chunksize=args.chunksize, extract_mode=args.feedback_extract_mode,
+                                        timezone=args.timezone, excluded_users=args.exclude_users,
+                                        report=feedback_report, model_aliases=model_aliases)
+    finally:
+        dispose_engines()
+        if snapshot_path:
+            try:
+                Path(snapshot_path).unlink()
+                logger.info(f"数据库快照已删除: {snapshot_path}")
+            except OSError as e:
+                logger.warning(f"删除数据库快照 {snapshot_path} 失败: {e}")
 
 
     if chat_df.empty:
@@ -268,6 +663,16 @@ if __name__ == "__main__":
         # 2. 生成汇总统计
         logger.info("数据获取成功，开始生成汇总统计...")
         summary_data = generate_summary_stats(chat_df, feedback_df)
+
+        # 运行报告：记录本次运行的抽取配置，便于对照性能和结果
+        summary_data['run_report'] = {
+            'json_decoder': json_codec.decoder_name(),
+            'timezone': args.timezone,
+            'branch_mode': args.branch_mode,
+            'excluded_users': sorted(DEFAULT_EXCLUDED_USERS if args.exclude_users is None else set(args.exclude_users)),
+            'feedback_parse': feedback_report.to_dict(),
+            'model_aliases': model_aliases._asdict(),
+        }
         
         # 可选：保存详细的DataFrame数据
         save_all_data(chat_df, feedback_df)
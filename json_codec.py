@@ -0,0 +1,169 @@
+import json
+import logging
+from typing import Any, Dict, TypedDict
+
+# 可选的高速JSON解码库，未安装时退回标准库 json
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 只获取logger实例，不进行配置
+logger = logging.getLogger(__name__)
+
+# 'auto' 按 msgspec > orjson > json 的顺序选择已安装的后端
+DECODER_BACKENDS = ('auto', 'msgspec', 'orjson', 'json')
+
+# 各后端在JSON不合法时抛出的异常。orjson.JSONDecodeError 是 json.JSONDecodeError 的子类
+JSON_DECODE_ERRORS = (json.JSONDecodeError,) + ((msgspec.DecodeError,) if msgspec is not None else ())
+
+
+# --- Open WebUI 数据结构 ---
+# 只声明解析时会读取的字段。使用 msgspec 后端时按这些结构解码，未声明的字段（例如会话快照中
+# 重复保存的 messages 列表、files、tags 等）在解码时直接跳过，不会创建Python对象。
+# 字段取值在不同版本的 Open WebUI 中并不统一，因此叶子字段一律使用 Any。
+
+class Message(TypedDict, total=False):
+    role: Any
+    model: Any
+    models: Any
+    parentId: Any
+    childrenIds: Any
+    timestamp: Any
+    content: Any
+    usage: Any
+    info: Any
+    error: Any
+    done: Any
+
+
+class History(TypedDict, total=False):
+    messages: Dict[str, Message]
+    currentId: Any
+
+
+class Chat(TypedDict, total=False):
+    id: Any
+    title: Any
+    models: Any
+    history: History
+
+
+class SnapshotChat(TypedDict, total=False):
+    chat: Chat
+
+
+class FeedbackSnapshot(TypedDict, total=False):
+    chat: SnapshotChat
+
+
+_backend = None
+_loads = None
+_typed_decoders = {}
+
+
+def set_decoder(backend: str = 'auto') -> str:
+    """
+    选择JSON解码后端。
+
+    Args:
+        backend (str): 'auto'、'msgspec'、'orjson' 或 'json'。
+
+    Returns:
+        str: 实际使用的后端名称。
+
+    Raises:
+        ValueError: 后端名称不合法，或指定的后端未安装。
+    """
+    global _backend, _loads, _typed_decoders
+    if backend not in DECODER_BACKENDS:
+        raise ValueError(f"不支持的JSON解码后端: {backend}，可选: {DECODER_BACKENDS}")
+    if backend == 'auto':
+        backend = 'msgspec' if msgspec is not None else 'orjson' if orjson is not None else 'json'
+    if (backend == 'msgspec' and msgspec is None) or (backend == 'orjson' and orjson is None):
+        raise ValueError(f"JSON解码后端 {backend} 未安装")
+
+    if backend == 'msgspec':
+        _loads = msgspec.json.decode
+        _typed_decoders = {
+            schema: msgspec.json.Decoder(schema)
+            for schema in (Chat, FeedbackSnapshot, Message)
+        }
+    else:
+        _loads = orjson.loads if backend == 'orjson' else json.loads
+        _typed_decoders = {}
+    _backend = backend
+    logger.info(f"JSON解码后端: {backend}")
+    return backend
+
+
+def decoder_name() -> str:
+    """
+    返回当前使用的JSON解码后端名称，写入运行报告。
+    """
+    return _backend
+
+
+def _loads_fallback(data, error: Exception):
+    """
+    msgspec 和 orjson 严格按JSON标准拒绝 NaN、Infinity 等标准库 json 接受的取值，
+    高速后端解码失败时用标准库再解码一次，标准库也失败时才按不合法的JSON处理（抛出原来的异常）。
+    """
+    if _backend == 'json':
+        raise error
+    try:
+        return json.loads(data)
+    except json.JSONDecodeError:
+        raise error from None
+
+
+def loads(data):
+    """
+    使用当前后端解码任意JSON。
+    """
+    try:
+        return _loads(data)
+    except JSON_DECODE_ERRORS as e:
+        return _loads_fallback(data, e)
+
+
+def _decode_typed(data, schema):
+    decoder = _typed_decoders.get(schema)
+    if decoder is None:
+        return loads(data)
+    try:
+        return decoder.decode(data)
+    except msgspec.ValidationError:
+        # JSON本身合法但结构不符合声明（例如 messages 不是对象），不退回标准库
+        raise
+    except msgspec.DecodeError as e:
+        return _loads_fallback(data, e)
+
+
+def decode_chat(data) -> Chat:
+    """
+    解码 chat 表中的会话JSON。
+    """
+    return _decode_typed(data, Chat)
+
+
+def decode_feedback_snapshot(data) -> FeedbackSnapshot:
+    """
+    解码 feedback 表中的会话快照。
+    """
+    return _decode_typed(data, FeedbackSnapshot)
+
+
+def decode_message(data) -> Message:
+    """
+    解码单条消息（SQL抽取模式下取出的回答或问题）。
+    """
+    return _decode_typed(data, Message)
+
+
+set_decoder()
@@ -0,0 +1,77 @@
+import json
+import logging
+from pathlib import Path
+from typing import NamedTuple
+
+import pandas as pd
+
+from frame_utils import recode_categories, drop_categories
+
+# 只获取logger实例，不进行配置
+logger = logging.getLogger(__name__)
+
+# 默认的模型别名表 {原名称: 统一后的名称}：同一模型在不同时期或不同配置中的名称统一为一个
+DEFAULT_MODEL_ALIASES = {
+    '星伴V1.1': '聆境 1.1',
+    '聆镜 1.1': '聆境 1.1',
+}
+
+# 默认不计入统计的模型，按别名替换之后的名称匹配
+DEFAULT_EXCLUDED_MODELS = ('星伴V1.1', '星伴v1.2', 'arena-model')
+
+
+class ModelAliasTable(NamedTuple):
+    """
+    模型名称的别名表和排除列表。
+    """
+    aliases: dict  # {原名称: 统一后的名称}
+    excluded: tuple  # 不计入统计的模型
+
+
+DEFAULT_MODEL_ALIAS_TABLE = ModelAliasTable(DEFAULT_MODEL_ALIASES, DEFAULT_EXCLUDED_MODELS)
+
+
+def load_model_alias_table(path) -> ModelAliasTable:
+    """
+    从JSON文件读取模型别名表，格式为 {"aliases": {原名称: 统一后的名称}, "excluded": [模型, ...]}。
+    缺少的键使用默认值，例如只写 aliases 时沿用默认的排除列表。
+
+    Raises:
+        ValueError: 文件内容不是合法的别名表。
+    """
+    with open(Path(path), encoding='utf-8') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"模型别名表必须是JSON对象: {path}")
+    aliases = config.get('aliases', DEFAULT_MODEL_ALIASES)
+    excluded = config.get('excluded', DEFAULT_EXCLUDED_MODELS)
+    if not isinstance(aliases, dict) or not all(isinstance(value, str) for value in aliases.values()):
+        raise ValueError(f"aliases 必须是 {{原名称: 统一后的名称}} 形式的对象: {path}")
+    if isinstance(excluded, str) or not all(isinstance(value, str) for value in excluded):
+        raise ValueError(f"excluded 必须是模型名称的列表: {path}")
+    return ModelAliasTable(dict(aliases), tuple(excluded))
+
+
+def apply_model_alias_table(df: pd.DataFrame, table: ModelAliasTable, columns, filter_column: str) -> pd.DataFrame:
+    """
+    加载数据时统一模型名称：先按别名表重命名 columns 中各 category 列的类别，
+    再删除 filter_column 属于排除列表的行。只处理类别，不逐行替换字符串。
+
+    Args:
+        df (pd.DataFrame): 模型列已转换为 category 类型的数据。
+        table (ModelAliasTable): 别名表和排除列表。
+        columns (Iterable[str]): 需要统一名称的模型列。
+        filter_column (str): 按该列的模型排除数据行。
+
+    Returns:
+        pd.DataFrame: 处理后的数据，不存在的列会被跳过。
+    """
+    for column in columns:
+        if column in df.columns:
+            df[column] = recode_categories(df[column], table.aliases)
+    if filter_column in df.columns:
+        before = len(df)
+        df = drop_categories(df, filter_column, table.excluded)
+        if len(df) < before:
+            logger.info(f"按模型排除列表过滤掉 {before - len(df)} 行（{filter_column}）")
+    return df
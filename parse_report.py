@@ -0,0 +1,94 @@
+import json
+import logging
+import datetime
+from collections import Counter
+from pathlib import Path
+
+# 只获取logger实例，不进行配置
+logger = logging.getLogger(__name__)
+
+# 每种原因保留的样本记录数
+DEFAULT_SAMPLE_SIZE = 20
+
+# 隔离文件目录，与其它产出文件一起放在 df_data 下
+DEFAULT_QUARANTINE_DIR = Path(__file__).parent / "df_data" / "quarantine"
+
+
+class ParseReport:
+    """
+    按原因统计解析时被跳过的记录，并为每种原因保留少量样本ID。
+
+    解析循环中只做计数，不逐条写日志；一次运行结束后输出一条汇总日志，
+    样本写入隔离文件供排查，计数写入运行报告。
+    """
+
+    def __init__(self, name: str, sample_size: int = DEFAULT_SAMPLE_SIZE):
+        """
+        Args:
+            name (str): 数据源名称，例如 'feedback'，用于日志和隔离文件名。
+            sample_size (int): 每种原因最多保留的样本数。
+        """
+        self.name = name
+        self.sample_size = sample_size
+        self.counts = Counter()
+        self.samples = {}
+
+    def add(self, reason: str, record_id, detail=None):
+        """
+        记录一条被跳过的记录。
+
+        Args:
+            reason (str): 跳过原因。
+            record_id: 记录ID。
+            detail (optional): 附加信息，例如异常描述或找不到的 message_id。
+        """
+        self.counts[reason] += 1
+        samples = self.samples.setdefault(reason, [])
+        if len(samples) < self.sample_size:
+            sample = {'id': record_id}
+            if detail is not None:
+                sample['detail'] = str(detail)
+            samples.append(sample)
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def to_dict(self) -> dict:
+        """
+        返回写入运行报告的计数。
+        """
+        return {'skipped': self.total, 'by_reason': dict(sorted(self.counts.items()))}
+
+    def log_summary(self):
+        """
+        输出本次运行的汇总日志。
+        """
+        if not self.total:
+            logger.info(f"{self.name} 解析完成，没有被跳过的记录")
+            return
+        reasons = "，".join(f"{reason}: {count}" for reason, count in sorted(self.counts.items()))
+        logger.warning(f"{self.name} 解析时共跳过 {self.total} 条记录（{reasons}），样本见隔离文件")
+
+    def write_quarantine(self, quarantine_dir=None) -> Path:
+        """
+        将计数和样本ID写入隔离文件 {quarantine_dir}/{日期}_{name}.json，同一天多次运行时覆盖。
+
+        Args:
+            quarantine_dir (str | Path, optional): 隔离文件目录，默认为 df_data/quarantine。
+
+        Returns:
+            Path: 隔离文件路径。
+        """
+        quarantine_dir = Path(quarantine_dir) if quarantine_dir else DEFAULT_QUARANTINE_DIR
+        quarantine_dir.mkdir(parents=True, exist_ok=True)
+        time_now = datetime.datetime.now().strftime("%Y-%m-%d")
+        path = quarantine_dir / f"{time_now}_{self.name}.json"
+        content = {
+            'generated_at': datetime.datetime.now().isoformat(),
+            **self.to_dict(),
+            'samples': self.samples,
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(content, f, ensure_ascii=False, indent=2, default=str)
+        return path
@@ -0,0 +1,107 @@
+import math
+
+import numpy as np
+
+# 分位数估计的相对误差上限：估计值与真实分位数对应的样本值之差不超过其 1%
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# 不大于该值的样本（包括0和负数，例如时钟偏差导致的负延迟）计入零桶
+MIN_POSITIVE_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """
+    可合并的分位数草图（DDSketch）：正数样本按 gamma 的幂次对数分桶，只保存每个桶的计数。
+
+    任意分位数的估计值都满足给定的相对误差；两个草图的合并只是桶计数相加，
+    因此按天、按模型计算的草图可以保存下来，之后再合并为按周、按月等更粗的粒度，而不需要原始数据。
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        """
+        Args:
+            relative_accuracy (float): 相对误差上限，取值在 (0, 1) 之间。
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"相对误差必须在 (0, 1) 之间: {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, values):
+        """
+        批量加入样本，空值被忽略。
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        positive = values[values > MIN_POSITIVE_VALUE]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        if len(positive):
+            keys, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64),
+                                     return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.bins[key] = self.bins.get(key, 0) + count
+        return self
+
+    def merge(self, other: 'QuantileSketch'):
+        """
+        将另一个草图合并进来，两者的相对误差必须相同。
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("只能合并相对误差相同的草图")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float):
+        """
+        估计分位数。
+
+        Args:
+            q (float): 分位点，取值在 [0, 1] 之间，例如 0.9 表示 p90。
+
+        Returns:
+            float | None: 分位数估计值；草图为空时返回 None。
+        """
+        if not 0 <= q <= 1:
+            raise ValueError(f"分位点必须在 [0, 1] 之间: {q}")
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for key in sorted(self.bins):
+            cumulative += self.bins[key]
+            if cumulative > rank:
+                # 桶 key 覆盖 (gamma^(key-1), gamma^key]，取使相对误差最小的代表值
+                return 2 * self._gamma ** key / (self._gamma + 1)
+        return 2 * self._gamma ** max(self.bins) / (self._gamma + 1)
+
+    def to_dict(self) -> dict:
+        """
+        序列化为可写入JSON的字典。
+        """
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'count': self.count,
+            'zero_count': self.zero_count,
+            'bins': {str(key): count for key, count in sorted(self.bins.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'QuantileSketch':
+        """
+        由 to_dict 的结果恢复草图。
+        """
+        sketch = cls(data['relative_accuracy'])
+        sketch.bins = {int(key): count for key, count in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        return sketch